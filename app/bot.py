@@ -1,12 +1,24 @@
 """Telegram Bot process - Single service with integrated download."""
 
 import asyncio
-import json
+import atexit
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict, Any, Tuple
+import os
+import queue
+import threading
+import weakref
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Set, Tuple, Callable, Union
 from pathlib import Path
+from logging.handlers import (
+    MemoryHandler,
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+)
 
+import httpx
+import orjson
 from telegram import Update, Message, Bot
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from telegram.error import TelegramError, NetworkError, TimedOut
@@ -16,15 +28,84 @@ from app import database as db
 from app import file_manager as fm
 from app import markdown_logger as md
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(config.LOG_PATH / "bot.log"),
-        logging.StreamHandler(),
-    ],
-)
+
+# bot.log rotation, and buffering of its writes: records are flushed in
+# batches of LOG_BUFFER_CAPACITY, at ERROR, and every LOG_FLUSH_INTERVAL
+# seconds by a timer thread, so a quiet bot doesn't sit on buffered lines
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_BUFFER_CAPACITY = 500
+LOG_FLUSH_INTERVAL = 2.0
+
+
+class _BufferedLogHandler(MemoryHandler):
+    """MemoryHandler that is also flushed periodically by a daemon thread."""
+
+    def __init__(self, target: logging.Handler):
+        super().__init__(
+            LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=target
+        )
+        self._stop_flusher = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="log-flush", daemon=True
+        )
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stop_flusher.wait(LOG_FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        self._stop_flusher.set()
+        super().close()
+
+
+# File log buffer (set by _setup_logging); flushed on exit
+_log_buffer: Optional[_BufferedLogHandler] = None
+
+
+# Setup logging: handlers enqueue records and a listener thread does the
+# actual file/console writes, so logging never blocks the event loop
+def _setup_logging():
+    global _log_buffer
+    # Importing this module a second time (e.g. as app.bot after running it
+    # as __main__) must not start another listener or open bot.log twice
+    root = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return
+
+    log_formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    file_handler = RotatingFileHandler(
+        config.LOG_PATH / "bot.log",
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+    )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(log_formatter)
+
+    # Console output stays unbuffered; only the file writes are batched
+    _log_buffer = _BufferedLogHandler(file_handler)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(log_queue, _log_buffer, stream_handler)
+    listener.start()
+    # atexit runs these in reverse: drain the queue, then flush the buffer
+    atexit.register(_log_buffer.flush)
+    atexit.register(listener.stop)
+
+    # The queue handler only renders the message (plus any traceback); the
+    # listener's handlers apply the full format
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+
+_setup_logging()
+
 logger = logging.getLogger(__name__)
 
 # Suppress noisy httpx logs
@@ -33,11 +114,28 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 # Reduce noisy PTB polling logs; we'll surface key info ourselves.
 logging.getLogger("telegram.ext.Updater").setLevel(logging.WARNING)
 
-# Download semaphore for concurrency control
-download_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_DOWNLOADS)
+# Pending download jobs as (job_id, file_id, message_id); drained by a fixed
+# pool of MAX_CONCURRENT_DOWNLOADS workers, which bounds download concurrency.
+download_queue: asyncio.Queue = asyncio.Queue()
+
+# Download worker tasks (started in post_init)
+download_workers: List[asyncio.Task] = []
+
+# Post-download work (hash, save/upload, DB + markdown) runs in these tasks
+# so workers move on to the next download; at most MAX_CONCURRENT_DOWNLOADS
+# are pending, after which workers wait for a slot
+finalize_tasks: Set[asyncio.Task] = set()
+finalize_slots = asyncio.Semaphore(config.MAX_CONCURRENT_DOWNLOADS)
+
+
+def _iso_utc_now() -> str:
+    """Current UTC time as ISO 8601 with a trailing Z."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
 
-# Track background tasks
-background_tasks: set = set()
+def _iso_utc(dt: datetime) -> str:
+    """Format an aware Telegram datetime (second precision) as ISO 8601 Z."""
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
 # ============ Error Handling ==========
@@ -45,6 +143,9 @@ background_tasks: set = set()
 
 _last_network_error_log_ts: float = 0.0
 
+# Running event loop, cached in post_init for cheap loop.time() calls
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Global PTB error handler.
@@ -56,7 +157,7 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     err = context.error
     if isinstance(err, (NetworkError, TimedOut)):
         # Throttle repetitive polling errors to avoid log spam.
-        now = asyncio.get_running_loop().time()
+        now = (_loop or asyncio.get_running_loop()).time()
         global _last_network_error_log_ts
         if now - _last_network_error_log_ts >= 60:
             _last_network_error_log_ts = now
@@ -69,45 +170,84 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
 # ============ Download Functions ============
 
 
+def build_download_client() -> httpx.AsyncClient:
+    """Build the shared HTTP client used to stream Bot API file downloads."""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            connect=config.BOT_CONNECT_TIMEOUT,
+            read=config.BOT_READ_TIMEOUT,
+            write=config.BOT_WRITE_TIMEOUT,
+            pool=config.BOT_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(max_connections=config.MAX_CONCURRENT_DOWNLOADS),
+    )
+
+
 async def download_with_bot_api(
     bot: Bot,
+    http_client: httpx.AsyncClient,
     file_id: str,
     target_path: Path,
-) -> Tuple[bool, Optional[str]]:
-    """Try to download file using Bot API."""
+) -> Tuple[bool, Optional[str], Optional[str], Optional[int]]:
+    """
+    Download file using Bot API, hashing bytes as they are written.
+
+    The response is streamed in STREAM_CHUNK_SIZE chunks, so memory use
+    stays constant regardless of file size.
+
+    Returns:
+        (success, error, sha256, size)
+    """
     try:
         file = await bot.get_file(file_id)
-        temp_path = fm.get_temp_path(target_path)
-        temp_path.parent.mkdir(parents=True, exist_ok=True)
-        await file.download_to_drive(custom_path=str(temp_path))
-        await fm.atomic_write(temp_path, target_path)
-        return True, None
+        async with http_client.stream("GET", file.file_path) as resp:
+            resp.raise_for_status()
+            sha256, size = await fm.write_stream(
+                resp.aiter_bytes(fm.STREAM_CHUNK_SIZE), target_path
+            )
+        return True, None, sha256, size
+    except httpx.HTTPStatusError as e:
+        # The message would include the file URL, which embeds the token
+        return False, f"HTTP {e.response.status_code}", None, None
+    except httpx.HTTPError as e:
+        return False, f"{type(e).__name__}: {_redact_token(str(e))}", None, None
     except TelegramError as e:
-        return False, str(e)
+        return False, str(e), None, None
     except Exception as e:
-        return False, str(e)
+        return False, _redact_token(str(e)), None, None
+
+
+def _redact_token(text: str) -> str:
+    """Mask the bot token in error text (file URLs embed it)."""
+    return text.replace(config.BOT_TOKEN, "<token>")
 
 
 async def download_file(
     bot: Bot,
+    http_client: httpx.AsyncClient,
     file_info: Dict[str, Any],
     target_path: Path,
     source_info: Optional[Dict[str, Any]],
     original_message_id: Optional[int],
-) -> Tuple[bool, Optional[str], Optional[str], Optional[str]]:
+) -> Tuple[
+    bool, str, Optional[str], Optional[int], Optional[str], Optional[str]
+]:
     """
     Download file: try Bot API first, then tdl.
 
     Returns:
-        (success, method, bot_api_error, tdl_error)
+        (success, method, sha256, size, bot_api_error, tdl_error)
         method: "bot_api" | "tdl" | "failed"
+        sha256 is only known for streamed (Bot API) downloads.
     """
     file_id = file_info["file_id"]
 
     # 1. Try Bot API
-    success, bot_error = await download_with_bot_api(bot, file_id, target_path)
+    success, bot_error, sha256, size = await download_with_bot_api(
+        bot, http_client, file_id, target_path
+    )
     if success:
-        return True, "bot_api", None, None
+        return True, "bot_api", sha256, size, None, None
 
     logger.info(f"Bot API failed: {bot_error}, trying tdl...")
 
@@ -119,14 +259,15 @@ async def download_file(
     )
 
     if not message_url:
-        return False, "failed", bot_error, "Cannot build message URL"
+        return False, "failed", None, None, bot_error, "Cannot build message URL"
 
     success, tdl_error = await fm.download_with_tdl(message_url, target_path)
     if success:
-        return True, "tdl", bot_error, None
+        size = await asyncio.to_thread(os.path.getsize, target_path)
+        return True, "tdl", None, size, bot_error, None
 
     # 3. Both failed
-    return False, "failed", bot_error, tdl_error
+    return False, "failed", None, None, bot_error, tdl_error
 
 
 # ============ Background Download Task ============
@@ -134,143 +275,252 @@ async def download_file(
 
 async def process_download_job(
     bot: Bot,
+    http_client: httpx.AsyncClient,
     job_id: int,
     file_id: int,
     message_id: int,
 ):
     """Process a single download job in background."""
-    async with download_semaphore:
-        try:
-            await db.update_job_running(job_id)
-
-            # Get file and message info
-            file_record = await db.get_file_by_id(file_id)
-            message = await db.get_message_by_id(message_id)
-
-            if not file_record or not message:
-                await db.update_job_failed(job_id, "Record not found")
-                return
+    try:
+        # Get file and message info
+        file_record = await db.get_file_by_id(file_id)
+        message = await db.get_message_by_id(message_id)
+
+        if not file_record or not message:
+            await db.update_job_failed(job_id, "Record not found")
+            return
+
+        # Get source info
+        source = None
+        if message.get("source_id"):
+            source = await db.get_source_by_id(message["source_id"])
+        if not source:
+            source = {"source_type": "unknown", "source_chat_id": 0}
+
+        # Generate target path
+        _, target_path = fm.get_archive_path(
+            source_type=source["source_type"],
+            source_chat_id=source["source_chat_id"],
+            title=source.get("title"),
+            file_unique_id=file_record["file_unique_id"],
+            original_name=file_record["original_name"],
+        )
 
-            # Get source info
-            source = None
-            if message.get("source_id"):
-                source = await db.get_source_by_id(message["source_id"])
-            if not source:
-                source = {"source_type": "unknown", "source_chat_id": 0}
+        # Download
+        file_info = {
+            "file_id": file_record["last_seen_file_id"],
+            "file_unique_id": file_record["file_unique_id"],
+        }
+
+        (
+            success,
+            method,
+            sha256,
+            actual_size,
+            bot_error,
+            tdl_error,
+        ) = await download_file(
+            bot=bot,
+            http_client=http_client,
+            file_info=file_info,
+            target_path=target_path,
+            source_info=source,
+            original_message_id=message.get("original_message_id"),
+        )
 
-            # Generate target path
-            _, target_path = fm.get_archive_path(
+        if success:
+            # Hashing (tdl) and storage/upload are disk- and WebDAV-bound;
+            # hand them off so this worker can start its next download
+            await finalize_slots.acquire()
+            task = asyncio.create_task(
+                finalize_download(
+                    job_id=job_id,
+                    file_id=file_id,
+                    message_id=message_id,
+                    file_unique_id=file_record["file_unique_id"],
+                    target_path=target_path,
+                    method=method,
+                    sha256=sha256,
+                    size=actual_size,
+                    received_at=message.get("received_at"),
+                )
+            )
+            finalize_tasks.add(task)
+            task.add_done_callback(_finalize_done)
+        else:
+            # Record failure
+            error_type = "BOTH_FAILED"
+            if not bot_error:
+                error_type = "TDL_ONLY"
+            elif not tdl_error:
+                error_type = "BOT_API_ONLY"
+
+            await db.fail_download(
+                job_id=job_id,
+                file_id=file_id,
+                file_unique_id=file_record["file_unique_id"],
                 source_type=source["source_type"],
                 source_chat_id=source["source_chat_id"],
-                title=source.get("title"),
-                file_unique_id=file_record["file_unique_id"],
                 original_name=file_record["original_name"],
+                error_type=error_type,
+                bot_api_error=bot_error,
+                tdl_error=tdl_error,
             )
 
-            # Download
-            file_info = {
-                "file_id": file_record["last_seen_file_id"],
-                "file_unique_id": file_record["file_unique_id"],
-            }
+            logger.error(f"Job {job_id} failed: {error_type}")
 
-            download_result = await download_file(
-                bot=bot,
-                file_info=file_info,
-                target_path=target_path,
-                source_info=source,
-                original_message_id=message.get("original_message_id"),
+            # Log to markdown
+            md.append_job_failed(
+                job_id=job_id,
+                message_id=message_id,
+                file_unique_id=file_record["file_unique_id"],
+                error_type=error_type,
+                bot_api_error=bot_error,
+                tdl_error=tdl_error,
+                received_at=message["received_at"],
             )
 
-            success, method, bot_error, tdl_error = (
-                download_result[0],
-                download_result[1],
-                download_result[2],
-                download_result[3],
-            )
+    except Exception as e:
+        logger.error(f"Job {job_id} exception: {e}", exc_info=True)
+        await db.update_job_failed(job_id, str(e))
 
-            if success:
-                # Calculate hash and save
-                actual_size = target_path.stat().st_size
-                sha256 = await fm.calculate_sha256(target_path)
 
-                await fm.save_file(target_path)
+async def finalize_download(
+    job_id: int,
+    file_id: int,
+    message_id: int,
+    file_unique_id: str,
+    target_path: Path,
+    method: str,
+    sha256: Optional[str],
+    size: Optional[int],
+    received_at: Optional[str],
+):
+    """Hash (if needed), store and record a downloaded file."""
+    try:
+        # Streamed downloads already hashed the bytes; tdl needs a pass
+        if sha256 is None:
+            sha256 = await fm.calculate_sha256(target_path)
+
+        await fm.save_file(target_path)
+
+        await db.complete_download(
+            job_id=job_id,
+            file_id=file_id,
+            local_path=str(target_path),
+            local_size=size,
+            sha256=sha256,
+        )
 
-                await db.update_file_downloaded(
-                    file_id=file_id,
-                    local_path=str(target_path),
-                    local_size=actual_size,
-                    sha256=sha256,
-                )
-                await db.update_job_done(job_id)
+        logger.info(f"Job {job_id} completed via {method}")
 
-                logger.info(f"Job {job_id} completed via {method}")
+        # Log to markdown
+        md.append_job_complete(
+            job_id=job_id,
+            message_id=message_id,
+            file_unique_id=file_unique_id,
+            local_path=str(target_path),
+            local_size=size,
+            method=method or "unknown",
+            received_at=received_at or _iso_utc_now(),
+        )
 
-                # Log to markdown
-                await md.append_job_complete(
-                    job_id=job_id,
-                    message_id=message_id,
-                    file_unique_id=file_record["file_unique_id"],
-                    local_path=str(target_path),
-                    local_size=actual_size,
-                    method=method or "unknown",
-                    received_at=message.get("received_at")
-                    or (datetime.utcnow().isoformat() + "Z"),
-                )
-            else:
-                # Record failure
-                error_type = "BOTH_FAILED"
-                if not bot_error:
-                    error_type = "TDL_ONLY"
-                elif not tdl_error:
-                    error_type = "BOT_API_ONLY"
-
-                await db.insert_download_failure(
-                    file_id=file_id,
-                    file_unique_id=file_record["file_unique_id"],
-                    source_type=source["source_type"],
-                    source_chat_id=source["source_chat_id"],
-                    original_name=file_record["original_name"],
-                    error_type=error_type,
-                    bot_api_error=bot_error,
-                    tdl_error=tdl_error,
-                )
+    except Exception as e:
+        logger.error(f"Job {job_id} finalize exception: {e}", exc_info=True)
+        await db.update_job_failed(job_id, str(e))
 
-                await db.update_file_failed(file_id)
-                await db.update_job_failed(
-                    job_id, f"Bot API: {bot_error}; tdl: {tdl_error}"
-                )
 
-                logger.error(f"Job {job_id} failed: {error_type}")
+def _finalize_done(task: asyncio.Task):
+    finalize_tasks.discard(task)
+    finalize_slots.release()
 
-                # Log to markdown
-                await md.append_job_failed(
-                    job_id=job_id,
-                    message_id=message_id,
-                    file_unique_id=file_record["file_unique_id"],
-                    error_type=error_type,
-                    bot_api_error=bot_error,
-                    tdl_error=tdl_error,
-                    received_at=message["received_at"],
-                )
 
-        except Exception as e:
-            logger.error(f"Job {job_id} exception: {e}", exc_info=True)
-            await db.update_job_failed(job_id, str(e))
+async def download_worker(bot: Bot, http_client: httpx.AsyncClient):
+    """Process queued download jobs one at a time, forever."""
+    while True:
+        job_id, file_id, message_id = await download_queue.get()
+        try:
+            await process_download_job(
+                bot, http_client, job_id, file_id, message_id
+            )
+        finally:
+            download_queue.task_done()
 
 
-def schedule_download(bot: Bot, job_id: int, file_id: int, message_id: int):
-    """Schedule a download job as background task."""
-    task = asyncio.create_task(process_download_job(bot, job_id, file_id, message_id))
-    background_tasks.add(task)
-    task.add_done_callback(background_tasks.discard)
+def schedule_download(job_id: int, file_id: int, message_id: int):
+    """Queue a download job for the background workers."""
+    download_queue.put_nowait((job_id, file_id, message_id))
 
 
 # ============ Message Handler ============
 
 
-def parse_forward_source(
-    message: Message,
-) -> Tuple[str, int, Optional[str], Optional[str]]:
+SourceInfo = Tuple[str, int, Optional[str], Optional[str]]
+OriginHandler = Callable[[Any], Optional[SourceInfo]]
+
+
+def _source_from_origin_channel(origin) -> Optional[SourceInfo]:
+    """MessageOriginChannel: post forwarded from a channel."""
+    chat = origin.chat
+    if chat:
+        return "channel", chat.id, chat.title, chat.username
+    return None
+
+
+def _source_from_origin_chat(origin) -> Optional[SourceInfo]:
+    """MessageOriginChat: message sent on behalf of a chat."""
+    chat = origin.sender_chat
+    if chat:
+        source_type = chat.type
+        if source_type not in ("channel", "supergroup", "group"):
+            source_type = "unknown"
+        return source_type, chat.id, chat.title, chat.username
+    return None
+
+
+def _source_from_origin_user(origin) -> Optional[SourceInfo]:
+    """MessageOriginUser: message sent by a known user."""
+    user = origin.sender_user
+    if user:
+        return "user", user.id, user.full_name, user.username
+    return None
+
+
+def _source_from_origin_hidden_user(origin) -> Optional[SourceInfo]:
+    """MessageOriginHiddenUser: user who hides their account in forwards."""
+    sender_name = origin.sender_user_name
+    if sender_name:
+        return "unknown", 0, sender_name, None
+    return None
+
+
+# forward_origin handlers keyed by class name. Keyed by name rather than by
+# class because the MessageOrigin* classes only exist in newer PTB releases.
+# Handlers are only reached through this table, so they can read the fields
+# of their origin class (and its Chat/User) directly.
+_ORIGIN_HANDLERS: Dict[str, OriginHandler] = {
+    "MessageOriginChannel": _source_from_origin_channel,
+    "MessageOriginChat": _source_from_origin_chat,
+    "MessageOriginUser": _source_from_origin_user,
+    "MessageOriginHiddenUser": _source_from_origin_hidden_user,
+}
+
+# Handlers resolved per origin class, so the class-name lookup above runs
+# once per class instead of once per message.
+_ORIGIN_HANDLERS_BY_TYPE: Dict[type, Optional[OriginHandler]] = {}
+
+
+def _get_origin_handler(origin_type: type) -> Optional[OriginHandler]:
+    """Resolve (and memoize) the forward_origin handler for a class."""
+    try:
+        return _ORIGIN_HANDLERS_BY_TYPE[origin_type]
+    except KeyError:
+        handler = _ORIGIN_HANDLERS.get(origin_type.__name__)
+        _ORIGIN_HANDLERS_BY_TYPE[origin_type] = handler
+        return handler
+
+
+def parse_forward_source(message: Message) -> SourceInfo:
     """
     Parse forward source from message.
 
@@ -278,68 +528,28 @@ def parse_forward_source(
         (source_type, source_chat_id, title, username)
     """
     # Try forward_origin (new API)
-    if hasattr(message, "forward_origin") and message.forward_origin:
-        origin = message.forward_origin
-        origin_type = origin.__class__.__name__
-
-        if "Channel" in origin_type:
-            # ForwardOriginChannel
-            chat = getattr(origin, "chat", None)
-            if chat:
-                return "channel", chat.id, chat.title, getattr(chat, "username", None)
-        elif "Chat" in origin_type:
-            # ForwardOriginChat
-            chat = getattr(origin, "sender_chat", None)
-            if chat:
-                chat_type = chat.type
-                if chat_type == "channel":
-                    return (
-                        "channel",
-                        chat.id,
-                        chat.title,
-                        getattr(chat, "username", None),
-                    )
-                elif chat_type == "supergroup":
-                    return (
-                        "supergroup",
-                        chat.id,
-                        chat.title,
-                        getattr(chat, "username", None),
-                    )
-                elif chat_type == "group":
-                    return "group", chat.id, chat.title, getattr(chat, "username", None)
-                else:
-                    return (
-                        "unknown",
-                        chat.id,
-                        chat.title,
-                        getattr(chat, "username", None),
-                    )
-        elif "User" in origin_type:
-            # ForwardOriginUser
-            user = getattr(origin, "sender_user", None)
-            if user:
-                return "user", user.id, user.full_name, getattr(user, "username", None)
-        elif "HiddenUser" in origin_type:
-            # ForwardOriginHiddenUser
-            sender_name = getattr(origin, "sender_user_name", None)
-            if sender_name:
-                return "unknown", 0, sender_name, None
+    origin = getattr(message, "forward_origin", None)
+    if origin:
+        handler = _get_origin_handler(type(origin))
+        if handler:
+            source = handler(origin)
+            if source:
+                return source
 
     # Try old API
     if hasattr(message, "forward_from_chat") and message.forward_from_chat:
         chat = message.forward_from_chat
         chat_type = chat.type
         if chat_type == "channel":
-            return "channel", chat.id, chat.title, getattr(chat, "username", None)
+            return "channel", chat.id, chat.title, chat.username
         elif chat_type == "supergroup":
-            return "supergroup", chat.id, chat.title, getattr(chat, "username", None)
+            return "supergroup", chat.id, chat.title, chat.username
         elif chat_type == "group":
-            return "group", chat.id, chat.title, getattr(chat, "username", None)
+            return "group", chat.id, chat.title, chat.username
 
     if hasattr(message, "forward_from") and message.forward_from:
         user = message.forward_from
-        return "user", user.id, user.full_name, getattr(user, "username", None)
+        return "user", user.id, user.full_name, user.username
 
     if hasattr(message, "forward_sender_name") and message.forward_sender_name:
         return "unknown", 0, message.forward_sender_name, None
@@ -348,10 +558,28 @@ def parse_forward_source(
     return "unknown", 0, None, None
 
 
+# Attachment fields as (attribute, kind, fixed_mime, default_ext). A message
+# carries at most one of these, so extraction stops at the first hit.
+# animation precedes document: Telegram also sets document on animations.
+_FILE_FIELDS: Tuple[Tuple[str, str, Optional[str], Optional[str]], ...] = (
+    ("animation", "animation", None, ".mp4"),
+    ("document", "document", None, None),
+    ("photo", "photo", "image/jpeg", ".jpg"),
+    ("video", "video", None, ".mp4"),
+    ("audio", "audio", None, ".mp3"),
+    ("voice", "voice", None, ".ogg"),
+    ("sticker", "sticker", "image/webp", ".webp"),
+)
+
+_ENABLED_KINDS = frozenset(config.ENABLED_ATTACHMENT_KINDS)
+
+
 def extract_file_info(message: Message) -> List[Dict[str, Any]]:
     """
     Extract file information from message.
 
+    Attachments whose kind is not in ENABLED_ATTACHMENT_KINDS are skipped.
+
     Returns list of dicts with keys:
         - kind: document|photo|video|audio|voice|animation|sticker
         - file_id: Telegram file_id
@@ -360,107 +588,71 @@ def extract_file_info(message: Message) -> List[Dict[str, Any]]:
         - mime_type: MIME type
         - original_name: Original filename
     """
-    files = []
+    for attr, kind, fixed_mime, default_ext in _FILE_FIELDS:
+        obj = getattr(message, attr, None)
+        if not obj:
+            continue
 
-    # Document
-    if message.document:
-        doc = message.document
-        files.append(
-            {
-                "kind": "document",
-                "file_id": doc.file_id,
-                "file_unique_id": doc.file_unique_id,
-                "file_size": doc.file_size,
-                "mime_type": doc.mime_type,
-                "original_name": doc.file_name,
-            }
-        )
+        if kind not in _ENABLED_KINDS:
+            return []
 
-    # Photo (take largest)
-    if message.photo:
-        photo = message.photo[-1]  # Largest size
-        files.append(
-            {
-                "kind": "photo",
-                "file_id": photo.file_id,
-                "file_unique_id": photo.file_unique_id,
-                "file_size": photo.file_size,
-                "mime_type": "image/jpeg",
-                "original_name": f"{photo.file_unique_id}.jpg",
-            }
-        )
+        if kind == "photo":
+            obj = obj[-1]  # Largest size
 
-    # Video
-    if message.video:
-        video = message.video
-        files.append(
-            {
-                "kind": "video",
-                "file_id": video.file_id,
-                "file_unique_id": video.file_unique_id,
-                "file_size": video.file_size,
-                "mime_type": video.mime_type,
-                "original_name": video.file_name or f"{video.file_unique_id}.mp4",
-            }
-        )
+        original_name = getattr(obj, "file_name", None)
+        if not original_name and default_ext:
+            original_name = f"{obj.file_unique_id}{default_ext}"
 
-    # Audio
-    if message.audio:
-        audio = message.audio
-        files.append(
+        return [
             {
-                "kind": "audio",
-                "file_id": audio.file_id,
-                "file_unique_id": audio.file_unique_id,
-                "file_size": audio.file_size,
-                "mime_type": audio.mime_type,
-                "original_name": audio.file_name or f"{audio.file_unique_id}.mp3",
+                "kind": kind,
+                "file_id": obj.file_id,
+                "file_unique_id": obj.file_unique_id,
+                "file_size": obj.file_size,
+                "mime_type": fixed_mime or getattr(obj, "mime_type", None),
+                "original_name": original_name,
             }
-        )
+        ]
 
-    # Voice
-    if message.voice:
-        voice = message.voice
-        files.append(
-            {
-                "kind": "voice",
-                "file_id": voice.file_id,
-                "file_unique_id": voice.file_unique_id,
-                "file_size": voice.file_size,
-                "mime_type": voice.mime_type,
-                "original_name": f"{voice.file_unique_id}.ogg",
-            }
-        )
+    return []
 
-    # Animation (GIF)
-    if message.animation:
-        anim = message.animation
-        files.append(
-            {
-                "kind": "animation",
-                "file_id": anim.file_id,
-                "file_unique_id": anim.file_unique_id,
-                "file_size": anim.file_size,
-                "mime_type": anim.mime_type,
-                "original_name": anim.file_name or f"{anim.file_unique_id}.mp4",
-            }
-        )
 
-    # Sticker
-    if message.sticker:
-        sticker = message.sticker
-        files.append(
-            {
-                "kind": "sticker",
-                "file_id": sticker.file_id,
-                "file_unique_id": sticker.file_unique_id,
-                "file_size": sticker.file_size,
-                "mime_type": "image/webp",
-                "original_name": f"{sticker.file_unique_id}.webp",
-            }
-        )
+# Stored in messages.raw_json when the payload is not kept (STORE_RAW_JSON
+# disabled, or a non-forward with STORE_RAW_JSON_ONLY_FORWARDS)
+_EMPTY_RAW_JSON = "{}"
+
+
+def _serialize_message(message: Message) -> Union[str, bytes]:
+    """Serialize the full Telegram message for messages.raw_json."""
+    raw_json = orjson.dumps(message.to_dict())
+    if config.COMPRESS_RAW_JSON:
+        return db.encode_raw_json(raw_json)
+    return raw_json.decode()
+
+
+# Messages below these sizes serialize in well under the cost of a thread
+# hand-off, so they are serialized inline on the event loop
+INLINE_SERIALIZE_MAX_TEXT = 4096
+INLINE_SERIALIZE_MAX_ENTITIES = 32
+
+
+def _is_large_message(message: Message) -> bool:
+    """Whether serializing the message is worth moving to a thread."""
+    text = message.text or message.caption or ""
+    entities = message.entities or message.caption_entities
+    return (
+        len(text) > INLINE_SERIALIZE_MAX_TEXT
+        or len(entities) > INLINE_SERIALIZE_MAX_ENTITIES
+        or message.reply_markup is not None
+    )
 
-    return files
+
+# Updates are processed concurrently (concurrent_updates in main), so
+# messages from the same chat are serialized here to keep archive order.
+# Weak values: a chat's lock is dropped once no handler holds it.
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -469,29 +661,39 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not message:
         return
 
-    logger.info(f"Received message {message.message_id} from chat {message.chat_id}")
+    lock = _chat_locks.get(message.chat_id)
+    if lock is None:
+        lock = _chat_locks[message.chat_id] = asyncio.Lock()
+
+    async with lock:
+        await _archive_message(message)
+
+
+async def _archive_message(message: Message):
+    """Persist a message and its attachments, then queue downloads."""
+    logger.debug(f"Received message {message.message_id} from chat {message.chat_id}")
 
     try:
         # Parse timestamps
-        received_at = datetime.utcnow().isoformat() + "Z"
+        received_at = _iso_utc_now()
         forwarded_at = None
         if hasattr(message, "forward_date") and message.forward_date:
-            forwarded_at = message.forward_date.isoformat() + "Z"
+            forwarded_at = _iso_utc(message.forward_date)
 
         # Parse source
         source_type, source_chat_id, source_title, source_username = (
             parse_forward_source(message)
         )
 
-        # Upsert source
-        source_id = None
+        # Source row (upserted in the same transaction as the message)
+        source_row = None
         if source_chat_id != 0:
-            source_id = await db.upsert_source(
-                source_type=source_type,
-                source_chat_id=source_chat_id,
-                title=source_title,
-                username=source_username,
-            )
+            source_row = {
+                "source_type": source_type,
+                "source_chat_id": source_chat_id,
+                "title": source_title,
+                "username": source_username,
+            }
 
         # Get text
         text = message.text or message.caption
@@ -505,60 +707,51 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Old API
             original_message_id = message.forward_from_message_id
 
-        # Insert message
-        message_id = await db.insert_message(
-            tg_chat_id=message.chat_id,
-            tg_message_id=message.message_id,
-            original_message_id=original_message_id,
-            from_user_id=message.from_user.id if message.from_user else None,
-            received_at=received_at,
-            forwarded_at=forwarded_at,
-            source_id=source_id,
-            text=text,
-            raw_json=json.dumps(message.to_dict()),
-        )
-
-        logger.info(f"Inserted message {message_id} into database")
+        # Serialize the full message; large ones go off the event loop
+        # (to_dict walks the whole PTB object tree)
+        raw_json = _EMPTY_RAW_JSON
+        if config.STORE_RAW_JSON and (
+            forwarded_at is not None or not config.STORE_RAW_JSON_ONLY_FORWARDS
+        ):
+            if _is_large_message(message):
+                raw_json = await asyncio.to_thread(_serialize_message, message)
+            else:
+                raw_json = _serialize_message(message)
+
+        message_row = {
+            "tg_chat_id": message.chat_id,
+            "tg_message_id": message.message_id,
+            "original_message_id": original_message_id,
+            "from_user_id": message.from_user.id if message.from_user else None,
+            "received_at": received_at,
+            "forwarded_at": forwarded_at,
+            "text": text,
+            "raw_json": raw_json,
+        }
 
         # Extract files
         file_infos = extract_file_info(message)
+        file_rows = [dict(fi, caption=message.caption) for fi in file_infos]
+
+        # Insert source, message, files, links and jobs in one transaction
+        message_id, _, results = await db.process_message_atomic(
+            source_row, message_row, file_rows
+        )
+
+        logger.debug(f"Inserted message {message_id} into database")
 
         # Process each file
         attachments = []
-        for file_info in file_infos:
+        for file_info, result in zip(file_infos, results):
             file_unique_id = file_info["file_unique_id"]
-
-            # Upsert file
-            file_id = await db.upsert_file(
-                file_unique_id=file_unique_id,
-                last_seen_file_id=file_info["file_id"],
-                file_size=file_info["file_size"],
-                mime_type=file_info["mime_type"],
-                original_name=file_info["original_name"],
-            )
-
-            # Insert message_file link
-            await db.insert_message_file(
-                message_id=message_id,
-                file_id=file_id,
-                tg_file_id=file_info["file_id"],
-                tg_file_unique_id=file_unique_id,
-                kind=file_info["kind"],
-                caption=message.caption,
-            )
-
-            # Get file record
-            file_record = await db.get_file_by_id(file_id)
+            file_id = result["file_id"]
+            job_id = result["job_id"]
 
             # Check if already downloaded
-            if (
-                file_record
-                and file_record["status"] == "DOWNLOADED"
-                and file_record["local_path"]
-            ):
-                local_path = Path(file_record["local_path"])
-                if await fm.verify_file(local_path):
-                    logger.info(f"File {file_unique_id} already downloaded, skipping")
+            if result["status"] == "DOWNLOADED" and result["local_path"]:
+                local_path = result["local_path"]
+                if fm.verify_file(local_path):
+                    logger.debug(f"File {file_unique_id} already downloaded, skipping")
                     attachments.append(
                         {
                             "kind": file_info["kind"],
@@ -566,37 +759,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             "file_size": file_info["file_size"],
                             "file_unique_id": file_unique_id,
                             "status": "DOWNLOADED",
-                            "local_path": str(local_path),
+                            "local_path": local_path,
                             "is_duplicate": True,
                         }
                     )
                     continue
 
-            # Get source for path generation
-            source = await db.get_source_by_id(source_id) if source_id else None
-            if not source:
-                source = {"source_type": "unknown", "source_chat_id": 0}
-
-            # Generate target path
-            _, target_path = fm.get_archive_path(
-                source_type=source["source_type"],
-                source_chat_id=source["source_chat_id"],
-                title=source["title"],
-                file_unique_id=file_unique_id,
-                original_name=file_info["original_name"],
-            )
-
-            # Create job and schedule download
-            job_id = await db.insert_job(file_id=file_id, message_id=message_id)
+                # Recorded as downloaded but missing on disk: queue it again
+                job_id = await db.insert_job(file_id=file_id, message_id=message_id)
 
             if job_id:
                 schedule_download(
-                    bot=context.bot,
                     job_id=job_id,
                     file_id=file_id,
                     message_id=message_id,
                 )
-                logger.info(f"Scheduled download job {job_id}")
+                logger.debug(f"Scheduled download job {job_id}")
                 attachments.append(
                     {
                         "kind": file_info["kind"],
@@ -608,7 +786,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     }
                 )
             else:
-                logger.info(f"Job already exists for file {file_unique_id}")
+                logger.debug(f"Job already exists for file {file_unique_id}")
                 attachments.append(
                     {
                         "kind": file_info["kind"],
@@ -621,7 +799,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
 
         # Write to markdown
-        await md.append_message_entry(
+        md.append_message_entry(
             message_id=message_id,
             tg_chat_id=message.chat_id,
             tg_message_id=message.message_id,
@@ -645,29 +823,86 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application):
     """Initialize on startup."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+
+    # Let tasks run eagerly up to their first real suspension point, so
+    # handlers/jobs that finish without blocking skip the scheduler queue.
+    # asyncio.eager_task_factory only exists on Python 3.12+.
+    eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+    if eager_task_factory is not None:
+        _loop.set_task_factory(eager_task_factory)
+
     await db.init_db()
 
+    # Background markdown writer
+    md.start_writer()
+
+    # Shared HTTP client for Bot API file downloads (keeps connections alive)
+    http_client = build_download_client()
+    application.bot_data["http_client"] = http_client
+
+    # Start download workers
+    for _ in range(config.MAX_CONCURRENT_DOWNLOADS):
+        download_workers.append(
+            asyncio.create_task(download_worker(application.bot, http_client))
+        )
+
     # Resume pending jobs
-    pending_jobs = await db.get_pending_jobs()
-    for job in pending_jobs:
+    resumed = 0
+    async for job in db.iter_pending_jobs():
         schedule_download(
-            bot=application.bot,
             job_id=job["id"],
             file_id=job["file_id"],
             message_id=job["message_id"],
         )
-    if pending_jobs:
-        logger.info(f"Resumed {len(pending_jobs)} pending jobs")
+        resumed += 1
+    if resumed:
+        logger.info(f"Resumed {resumed} pending jobs")
+
+
+async def post_shutdown(application: Application):
+    """Release resources on shutdown."""
+    for worker in download_workers:
+        worker.cancel()
+    await asyncio.gather(*download_workers, return_exceptions=True)
+    download_workers.clear()
+
+    # Let downloaded files finish saving/recording before the DB closes
+    await asyncio.gather(*finalize_tasks, return_exceptions=True)
+
+    http_client = application.bot_data.pop("http_client", None)
+    if http_client is not None:
+        await http_client.aclose()
+
+    await fm.close_webdav_session()
+    fm.shutdown_hash_pool()
+    await md.stop_writer()
+    await db.close_db()
 
 
 def main():
     """Main bot entry point."""
     logger.info("Starting Telegram Archive Keeper")
 
+    # run_polling creates its loop through the current policy, so installing
+    # uvloop here is enough; fall back to the stock loop if it is missing
+    try:
+        import uvloop
+
+        uvloop.install()
+        logger.info("Using uvloop event loop")
+    except ImportError:
+        pass
+
     application = (
         Application.builder()
         .token(config.BOT_TOKEN)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Handle updates as they arrive so a slow chat does not hold up the
+        # others; per-chat ordering is kept by _chat_locks
+        .concurrent_updates(True)
         # Increase tolerance for unstable networks.
         # Note: getUpdates long-poll `timeout` is configured in run_polling.
         .connect_timeout(config.BOT_CONNECT_TIMEOUT)
@@ -678,12 +913,22 @@ def main():
         .get_updates_read_timeout(config.BOT_READ_TIMEOUT)
         .get_updates_write_timeout(config.BOT_WRITE_TIMEOUT)
         .get_updates_pool_timeout(config.BOT_POOL_TIMEOUT)
+        # Bot API calls (getFile from every download worker, replies) share
+        # one multiplexed HTTP/2 connection; the pool leaves headroom for
+        # the workers plus handler calls
+        .http_version("2")
+        .connection_pool_size(config.MAX_CONCURRENT_DOWNLOADS * 2)
         .build()
     )
 
-    application.add_handler(
-        MessageHandler(filters.ALL & ~filters.COMMAND, handle_message)
+    # Drop messages from other users in PTB's filter stage, before any
+    # parsing or DB work
+    allowed = (
+        filters.User(user_id=config.ALLOWED_USER_IDS)
+        if config.ALLOWED_USER_IDS
+        else filters.ALL
     )
+    application.add_handler(MessageHandler(allowed & ~filters.COMMAND, handle_message))
 
     application.add_error_handler(on_error)
 
@@ -692,12 +937,16 @@ def main():
     # Long polling settings:
     # - poll_interval: sleep between requests, helps reduce churn
     # - timeout: server-side long poll duration (getUpdates timeout)
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        poll_interval=config.BOT_POLL_INTERVAL,
-        timeout=config.BOT_GETUPDATES_TIMEOUT,
-        bootstrap_retries=-1,
-    )
+    try:
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            poll_interval=config.BOT_POLL_INTERVAL,
+            timeout=config.BOT_GETUPDATES_TIMEOUT,
+            bootstrap_retries=-1,
+        )
+    finally:
+        if _log_buffer is not None:
+            _log_buffer.flush()
 
 
 if __name__ == "__main__":
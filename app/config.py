@@ -2,10 +2,21 @@
 
 import os
 from pathlib import Path
+from typing import List
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Everything below is read once at import; modules use the typed constants.
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
 # Telegram Bot
 _BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not _BOT_TOKEN:
@@ -17,37 +28,74 @@ BOT_TOKEN: str = _BOT_TOKEN
 # - BOT_GETUPDATES_TIMEOUT: Telegram getUpdates long-poll wait time (seconds)
 # - BOT_*_TIMEOUT: HTTP client timeouts (seconds)
 # - BOT_POLL_INTERVAL: sleep between polling requests (seconds)
-BOT_POLL_INTERVAL = float(os.getenv("BOT_POLL_INTERVAL", "1.0"))
-BOT_GETUPDATES_TIMEOUT = int(os.getenv("BOT_GETUPDATES_TIMEOUT", "30"))
+BOT_POLL_INTERVAL: float = float(os.getenv("BOT_POLL_INTERVAL", "1.0"))
+BOT_GETUPDATES_TIMEOUT: int = int(os.getenv("BOT_GETUPDATES_TIMEOUT", "30"))
 
-BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "10"))
+BOT_CONNECT_TIMEOUT: float = float(os.getenv("BOT_CONNECT_TIMEOUT", "10"))
 # Keep this >= BOT_GETUPDATES_TIMEOUT + a buffer, and high enough for large downloads.
-BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "90"))
-BOT_WRITE_TIMEOUT = float(os.getenv("BOT_WRITE_TIMEOUT", "30"))
-BOT_POOL_TIMEOUT = float(os.getenv("BOT_POOL_TIMEOUT", "5"))
+BOT_READ_TIMEOUT: float = float(os.getenv("BOT_READ_TIMEOUT", "90"))
+BOT_WRITE_TIMEOUT: float = float(os.getenv("BOT_WRITE_TIMEOUT", "30"))
+BOT_POOL_TIMEOUT: float = float(os.getenv("BOT_POOL_TIMEOUT", "5"))
+
+# Keep the full Telegram message JSON in messages.raw_json
+STORE_RAW_JSON: bool = _env_bool("STORE_RAW_JSON", True)
+
+# Only keep raw_json for forwarded messages (the payload of a plain message
+# adds little beyond the text and attachment columns)
+STORE_RAW_JSON_ONLY_FORWARDS: bool = _env_bool("STORE_RAW_JSON_ONLY_FORWARDS", False)
+
+# Store large raw_json payloads zlib-compressed (cuts DB and WAL bytes; the
+# column then holds a BLOB for those rows, see database.encode_raw_json)
+COMPRESS_RAW_JSON: bool = _env_bool("COMPRESS_RAW_JSON", False)
+
+# Attachment kinds to archive (comma-separated), e.g. drop "sticker" to skip
+# sticker downloads entirely
+_ATTACHMENT_KINDS = os.getenv(
+    "ENABLED_ATTACHMENT_KINDS",
+    "document,photo,video,audio,voice,animation,sticker",
+).lower()
+ENABLED_ATTACHMENT_KINDS: List[str] = [
+    k.strip() for k in _ATTACHMENT_KINDS.split(",") if k.strip()
+]
+
+# Telegram user ids allowed to use the bot (comma-separated); empty accepts
+# messages from anyone
+ALLOWED_USER_IDS: List[int] = [
+    int(u) for u in os.getenv("ALLOWED_USER_IDS", "").split(",") if u.strip()
+]
 
 # Download settings
-MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+MAX_CONCURRENT_DOWNLOADS: int = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+
+# CPUs to pin tdl subprocesses to (taskset -c list, e.g. "2-5"); empty
+# leaves scheduling to the OS
+TDL_CPUSET: str = os.getenv("TDL_CPUSET", "").strip()
+
+# Markdown notes: entries are buffered and flushed (one write + fsync per
+# file) when the buffer reaches NOTES_MAX_BUFFER bytes or NOTES_BATCH_INTERVAL
+# seconds after the first buffered entry
+NOTES_BATCH_INTERVAL: float = float(os.getenv("NOTES_BATCH_INTERVAL", "2.0"))
+NOTES_MAX_BUFFER: int = int(os.getenv("NOTES_MAX_BUFFER", "1048576"))
 
 # Paths
-DB_PATH = Path(os.getenv("DB_PATH", "/data/task_db/app.db"))
-LOG_PATH = Path(os.getenv("LOG_PATH", "/data/logs"))
-FILES_PATH = Path(os.getenv("FILES_PATH", "/data/files"))
-NOTES_PATH = Path(os.getenv("NOTES_PATH", "/data/notes"))
-TASK_DB_PATH = DB_PATH.parent
+DB_PATH: Path = Path(os.getenv("DB_PATH", "/data/task_db/app.db"))
+LOG_PATH: Path = Path(os.getenv("LOG_PATH", "/data/logs"))
+FILES_PATH: Path = Path(os.getenv("FILES_PATH", "/data/files"))
+NOTES_PATH: Path = Path(os.getenv("NOTES_PATH", "/data/notes"))
+TASK_DB_PATH: Path = DB_PATH.parent
 
 # WebDAV settings (optional)
-WEBDAV_URL = os.getenv("WEBDAV_URL", "")
-WEBDAV_USERNAME = os.getenv("WEBDAV_USERNAME", "")
-WEBDAV_PASSWORD = os.getenv("WEBDAV_PASSWORD", "")
-WEBDAV_ENABLED = bool(WEBDAV_URL and WEBDAV_USERNAME and WEBDAV_PASSWORD)
+WEBDAV_URL: str = os.getenv("WEBDAV_URL", "")
+WEBDAV_USERNAME: str = os.getenv("WEBDAV_USERNAME", "")
+WEBDAV_PASSWORD: str = os.getenv("WEBDAV_PASSWORD", "")
+WEBDAV_ENABLED: bool = bool(WEBDAV_URL and WEBDAV_USERNAME and WEBDAV_PASSWORD)
 
 # Storage mode: local, webdav, or both (comma-separated)
 _STORAGE_MODE = os.getenv("STORAGE_MODE", "local").lower()
-STORAGE_MODES = [m.strip() for m in _STORAGE_MODE.split(",") if m.strip()]
+STORAGE_MODES: List[str] = [m.strip() for m in _STORAGE_MODE.split(",") if m.strip()]
 
-SAVE_TO_LOCAL = "local" in STORAGE_MODES
-SAVE_TO_WEBDAV = "webdav" in STORAGE_MODES
+SAVE_TO_LOCAL: bool = "local" in STORAGE_MODES
+SAVE_TO_WEBDAV: bool = "webdav" in STORAGE_MODES
 
 if SAVE_TO_WEBDAV and not WEBDAV_ENABLED:
     SAVE_TO_WEBDAV = False
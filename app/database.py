@@ -1,7 +1,25 @@
 """Database module for SQLite operations."""
 
+import asyncio
+import os
+import re
+import sqlite3
+import zlib
 import aiosqlite
-from typing import Optional, Dict, Any, List
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import (
+    Optional,
+    Dict,
+    Any,
+    List,
+    Tuple,
+    Union,
+    AsyncIterator,
+    AsyncContextManager,
+)
 import logging
 
 from app.config import DB_PATH
@@ -85,6 +103,13 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_one_active_per_file
 ON jobs(file_id)
 WHERE status IN ('QUEUED','RUNNING');
 
+-- Partial and covering: only live jobs are indexed, and resuming the queue
+-- reads (id, file_id, message_id) without touching the table. status has to
+-- be in the index too, or SQLite looks up each row to re-check the WHERE
+CREATE INDEX IF NOT EXISTS idx_jobs_pending
+ON jobs(id, file_id, message_id, status)
+WHERE status = 'QUEUED';
+
 -- 下载失败统计表
 CREATE TABLE IF NOT EXISTS download_failures (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -100,264 +125,649 @@ CREATE TABLE IF NOT EXISTS download_failures (
 );
 
 CREATE INDEX IF NOT EXISTS idx_failures_error_type ON download_failures(error_type);
-CREATE INDEX IF NOT EXISTS idx_failures_created_at ON download_failures(created_at);
+-- (created_at, error_type) covers the monthly stats query
+DROP INDEX IF EXISTS idx_failures_created_at;
+CREATE INDEX IF NOT EXISTS idx_failures_created_type ON download_failures(created_at, error_type);
 
 CREATE INDEX IF NOT EXISTS idx_message_files_file ON message_files(file_id);
 CREATE INDEX IF NOT EXISTS idx_messages_received_at ON messages(received_at);
 """
 
 
+# Per-connection settings: unlike journal_mode these are not persisted in the
+# database file, so every pooled connection has to apply them itself.
+#
+# cache_size is a per-connection ceiling, so the worst case is pool size
+# (writer + up to 8 readers) x 64 MiB; pages are only allocated as they are
+# actually read, which for this database stays far below that. busy_timeout
+# only matters for other connections holding the write lock (the sqlite3
+# CLI, or a brief WAL truncate by _checkpoint_loop), since in-process writes
+# are already serialized.
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA wal_autocheckpoint=1000",  # pages
+    "PRAGMA cache_size=-65536",  # 64 MiB page cache
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MiB memory-mapped reads
+)
+
+# Parsed statements kept per connection by sqlite3; long-lived pooled
+# connections reuse the compiled plans for the fixed set of queries below
+STATEMENT_CACHE_SIZE = 256
+
+
+def _dict_row(cursor: sqlite3.Cursor, row: Tuple[Any, ...]) -> Dict[str, Any]:
+    """Build result dicts directly instead of going through sqlite3.Row."""
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+class AsyncSQLitePool:
+    """
+    Small pool of long-lived aiosqlite connections.
+
+    Reads borrow one of up to ``max_size`` reader connections, which WAL lets
+    run alongside writes. All writes go through a single dedicated writer
+    connection, serialized by a lock, so in-process writers never contend
+    for the SQLite write lock (SQLITE_BUSY).
+
+    Reader rows come back as plain dicts; the writer returns plain tuples
+    (it only reads back ids and RETURNING columns).
+    """
+
+    def __init__(self, path: Path, min_size: int = 2, max_size: int = 8):
+        self._path = path
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._size = 0
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, reader: bool = False) -> aiosqlite.Connection:
+        if reader:
+            # Opened read-only: a write routed to a reader by mistake fails
+            # loudly instead of bypassing the writer lock
+            conn = await aiosqlite.connect(
+                f"{self._path.resolve().as_uri()}?mode=ro",
+                uri=True,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            conn.row_factory = _dict_row
+        else:
+            conn = await aiosqlite.connect(
+                self._path, cached_statements=STATEMENT_CACHE_SIZE
+            )
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        """Open the writer and the minimum number of reader connections."""
+        self._writer = await self._connect()
+        # Helpers rely on the connection-level pragma instead of setting it
+        # per call; fail fast if this SQLite build ignores it
+        cursor = await self._writer.execute("PRAGMA foreign_keys")
+        row = await cursor.fetchone()
+        if not row or row[0] != 1:
+            raise RuntimeError("SQLite foreign key enforcement is not available")
+        for _ in range(self._min_size):
+            self._idle.put_nowait(await self._connect(reader=True))
+            self._size += 1
+
+    async def close(self):
+        """Close all idle readers and the writer."""
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+            self._size -= 1
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a reader connection, opening a new one if below max_size."""
+        if self._idle.empty() and self._size < self._max_size:
+            self._size += 1
+            try:
+                conn = await self._connect(reader=True)
+            except Exception:
+                self._size -= 1
+                raise
+        else:
+            conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Hold the writer connection; uncommitted work is rolled back on error."""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+
+# Group commit: small status updates issued concurrently by download workers
+# are collected for up to WRITE_BATCH_WINDOW seconds (or WRITE_BATCH_MAX
+# statements) and committed together, so N updates share one WAL sync
+WRITE_BATCH_WINDOW = 0.001
+WRITE_BATCH_MAX = 64
+
+
+Statement = Tuple[str, Tuple[Any, ...]]
+
+
+class _WriteBatcher:
+    """Single flusher task committing queued write statements in batches."""
+
+    def __init__(self, pool: AsyncSQLitePool):
+        self._pool = pool
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything already submitted, then stop the flusher."""
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    def submit(self, *statements: Statement) -> "asyncio.Future[None]":
+        """
+        Queue one or more statements, applied together (all or none).
+
+        The future resolves once they are committed.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, fut))
+        return fut
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            # Give concurrent writers a moment to join this batch
+            await asyncio.sleep(WRITE_BATCH_WINDOW)
+            batch = [item]
+            stop = False
+            while len(batch) < WRITE_BATCH_MAX and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _apply(self, db: aiosqlite.Connection, statements: Tuple[Statement, ...]):
+        if len(statements) == 1:
+            # SQLite rolls back just the failing statement on error
+            await db.execute(*statements[0])
+            return
+
+        await db.execute("SAVEPOINT item")
+        try:
+            for sql, params in statements:
+                await db.execute(sql, params)
+        except sqlite3.Error:
+            # If the error already ended the whole transaction there is no
+            # savepoint left to unwind; _flush handles that case
+            if db.in_transaction:
+                await db.execute("ROLLBACK TO item")
+                await db.execute("RELEASE item")
+            raise
+        await db.execute("RELEASE item")
+
+    async def _flush(self, batch: List[Tuple[Tuple[Statement, ...], asyncio.Future]]):
+        # A failing item only fails its own future; the rest of the batch
+        # still commits. Some errors (SQLITE_FULL, IOERR, a RAISE(ROLLBACK)
+        # trigger) roll back the whole transaction instead: the offending
+        # item fails and the others are retried in a fresh transaction.
+        pending = batch
+        while pending:
+            errors: List[Optional[BaseException]] = []
+            aborted: Optional[Tuple[int, sqlite3.Error]] = None
+            try:
+                async with self._pool.writer() as db:
+                    await db.execute("BEGIN IMMEDIATE")
+                    for i, (statements, _) in enumerate(pending):
+                        try:
+                            await self._apply(db, statements)
+                            errors.append(None)
+                        except sqlite3.Error as e:
+                            if not db.in_transaction:
+                                aborted = (i, e)
+                                break
+                            errors.append(e)
+                    if aborted is None:
+                        await db.commit()
+            except Exception as e:
+                logger.error(f"Batched write of {len(pending)} items failed: {e}")
+                errors = [e] * len(pending)
+                aborted = None
+
+            if aborted is None:
+                break
+
+            i, error = aborted
+            logger.warning(f"Batched write rolled back by item {i}: {error}")
+            fut = pending[i][1]
+            if not fut.done():
+                fut.set_exception(error)
+            pending = pending[:i] + pending[i + 1 :]
+
+        for (_, fut), error in zip(pending, errors):
+            if fut.done():
+                continue
+            if error is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(error)
+
+
+# raw_json payloads at least this long are stored zlib-compressed when
+# COMPRESS_RAW_JSON is on; shorter ones gain little and stay plain text
+RAW_JSON_COMPRESS_MIN = 2048
+
+
+def encode_raw_json(raw_json: bytes) -> Union[str, bytes]:
+    """
+    Prepare serialized message JSON for messages.raw_json.
+
+    Large payloads become a zlib-compressed BLOB (SQLite keeps BLOBs as-is
+    in the TEXT column); everything else is stored as text.
+    """
+    if len(raw_json) >= RAW_JSON_COMPRESS_MIN:
+        return zlib.compress(raw_json)
+    return raw_json.decode()
+
+
+def decode_raw_json(value: Union[str, bytes]) -> str:
+    """Inverse of encode_raw_json; plain text rows pass through."""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode()
+    return value
+
+
+_pool: Optional[AsyncSQLitePool] = None
+_batcher: Optional[_WriteBatcher] = None
+_checkpoint_task: Optional[asyncio.Task] = None
+
+# Seconds between explicit WAL checkpoints; keeps the WAL file short so
+# readers do not have to scan a long log (autocheckpoint still applies).
+# Routine checkpoints are PASSIVE; the WAL is only truncated once it has
+# grown past WAL_TRUNCATE_BYTES.
+CHECKPOINT_INTERVAL = 30
+WAL_TRUNCATE_BYTES = 16 * 1024 * 1024
+
+# LRU of source rows by id; sources change rarely and are read per job.
+# Entries are dropped once a source upsert has committed; the epoch counts
+# those drops so a read that overlapped one doesn't re-cache its old row.
+SOURCE_CACHE_SIZE = 256
+_source_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+_source_cache_epoch = 0
+
+
+def _invalidate_source(source_id: int):
+    global _source_cache_epoch
+    _source_cache.pop(source_id, None)
+    _source_cache_epoch += 1
+
+
+def _now() -> str:
+    """Current UTC time in SQLite's datetime('now') format, for binding."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _read() -> AsyncContextManager[aiosqlite.Connection]:
+    """Borrow a pooled reader connection."""
+    if _pool is None:
+        raise RuntimeError("Database not initialized, call init_db() first")
+    return _pool.acquire()
+
+
+def _write() -> AsyncContextManager[aiosqlite.Connection]:
+    """Hold the pooled writer connection."""
+    if _pool is None:
+        raise RuntimeError("Database not initialized, call init_db() first")
+    return _pool.writer()
+
+
+def _submit(*statements: Statement) -> "asyncio.Future[None]":
+    """Queue (sql, params) statements for the next group commit."""
+    if _batcher is None:
+        raise RuntimeError("Database not initialized, call init_db() first")
+    return _batcher.submit(*statements)
+
+
+async def _checkpoint_loop():
+    """Periodically checkpoint the WAL, truncating it once it gets large.
+
+    Runs on its own connection with busy_timeout=0, outside the writer lock:
+    a checkpoint that would have to wait for a reader (or the writer) gives
+    up at once and is retried next interval, so batched writes never stall
+    behind it.
+    """
+    wal_path = f"{DB_PATH}-wal"
+    conn = await aiosqlite.connect(DB_PATH)
+    try:
+        await conn.execute("PRAGMA busy_timeout=0")
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                try:
+                    wal_size = os.path.getsize(wal_path)
+                except OSError:
+                    wal_size = 0
+                mode = "TRUNCATE" if wal_size >= WAL_TRUNCATE_BYTES else "PASSIVE"
+                cursor = await conn.execute(f"PRAGMA wal_checkpoint({mode})")
+                busy, _, _ = await cursor.fetchone()
+                if busy and mode == "TRUNCATE":
+                    logger.debug(
+                        f"WAL truncate skipped ({wal_size} bytes), readers active"
+                    )
+            except Exception as e:
+                logger.warning(f"WAL checkpoint failed: {e}")
+    finally:
+        await conn.close()
+
+
 async def init_db():
-    """Initialize database with schema."""
+    """Initialize database with schema and open the connection pool."""
+    global _pool, _batcher, _checkpoint_task
     async with aiosqlite.connect(DB_PATH) as db:
         await db.executescript(SCHEMA)
+        # Jobs are no longer marked RUNNING, but databases from older
+        # versions can hold RUNNING rows left by a crash or restart. Only
+        # QUEUED jobs are resumed, and the one-active-job index would block
+        # new jobs for those files forever, so hand them back to the queue.
+        await db.execute("UPDATE jobs SET status='QUEUED' WHERE status='RUNNING'")
         await db.commit()
+
+    if _pool is None:
+        _pool = AsyncSQLitePool(DB_PATH)
+        await _pool.open()
+        _batcher = _WriteBatcher(_pool)
+        _batcher.start()
+        _checkpoint_task = asyncio.create_task(_checkpoint_loop())
     logger.info(f"Database initialized at {DB_PATH}")
 
 
-async def upsert_source(
-    source_type: str,
-    source_chat_id: int,
-    title: Optional[str] = None,
-    username: Optional[str] = None,
-) -> int:
-    """Insert or update a source, return source_id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
+async def close_db():
+    """Flush batched writes and close the connection pool."""
+    global _pool, _batcher, _checkpoint_task
+    if _checkpoint_task is not None:
+        _checkpoint_task.cancel()
+        try:
+            await _checkpoint_task
+        except asyncio.CancelledError:
+            pass
+        _checkpoint_task = None
+    if _batcher is not None:
+        await _batcher.stop()
+        _batcher = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+_FILE_DOWNLOADED_SQL = """
+    UPDATE files
+    SET local_path=?, local_size=?, sha256=?, status='DOWNLOADED', updated_at=?
+    WHERE id=?
+"""
+
+_JOB_DONE_SQL = """
+    UPDATE jobs
+    SET status='DONE', completed_at=?
+    WHERE id=?
+"""
+
+
+async def complete_download(
+    job_id: int,
+    file_id: int,
+    local_path: str,
+    local_size: int,
+    sha256: Optional[str] = None,
+):
+    """Mark a file as downloaded and its job as done, atomically."""
+    await _submit(
+        (_FILE_DOWNLOADED_SQL, (local_path, local_size, sha256, _now(), file_id)),
+        (_JOB_DONE_SQL, (_now(), job_id)),
+    )
+
+
+async def get_file_by_id(file_id: int) -> Optional[Dict[str, Any]]:
+    """Get file by id."""
+    async with _read() as db:
+        cursor = await db.execute("SELECT * FROM files WHERE id=?", (file_id,))
+        row = await cursor.fetchone()
+        return row
+
+
+async def insert_job(file_id: int, message_id: int) -> Optional[int]:
+    """
+    Insert a job for a file. Returns job_id if inserted, None if already exists.
+    """
+    async with _write() as db:
         cursor = await db.execute(
             """
-            INSERT INTO sources (source_type, source_chat_id, title, username)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(source_type, source_chat_id) 
-            DO UPDATE SET title=excluded.title, username=excluded.username
+            INSERT INTO jobs (file_id, message_id, status)
+            VALUES (?, ?, 'QUEUED')
+            ON CONFLICT DO NOTHING
             RETURNING id
             """,
-            (source_type, source_chat_id, title, username),
+            (file_id, message_id),
         )
         row = await cursor.fetchone()
         await db.commit()
-        return row[0]
-
-
-async def insert_message(
-    tg_chat_id: int,
-    tg_message_id: int,
-    original_message_id: Optional[int],
-    from_user_id: Optional[int],
-    received_at: str,
-    forwarded_at: Optional[str],
-    source_id: Optional[int],
-    text: Optional[str],
-    raw_json: str,
-) -> int:
-    """Insert a message, return message_id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
+        return row[0] if row else None
+
+
+async def process_message_atomic(
+    source_row: Optional[Dict[str, Any]],
+    message_row: Dict[str, Any],
+    file_rows: List[Dict[str, Any]],
+) -> Tuple[int, Optional[int], List[Dict[str, Any]]]:
+    """
+    Persist one incoming message and its attachments in a single transaction.
+
+    Upserts the source, inserts the message, upserts every file, links them
+    via message_files and queues a job for each file that is not already
+    downloaded.
+
+    Args:
+        source_row: Dict with source_type, source_chat_id, title, username
+            (None for messages without a known source)
+        message_row: Dict with the messages columns except source_id
+        file_rows: List of dicts with keys file_unique_id, file_id,
+            file_size, mime_type, original_name, kind, caption
+
+    Returns:
+        (message_id, source_id, results) where results holds, per file row,
+        a dict with file_id, status, local_path and job_id (None if the file
+        is already downloaded or a job is already active)
+    """
+    async with _write() as db:
+        # Take the write lock up front instead of upgrading a read
+        # transaction midway (which can fail with SQLITE_BUSY)
+        await db.execute("BEGIN IMMEDIATE")
+        now = _now()
+
+        source_id = None
+        if source_row:
+            cursor = await db.execute(
+                """
+                INSERT INTO sources (source_type, source_chat_id, title, username)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(source_type, source_chat_id)
+                DO UPDATE SET title=excluded.title, username=excluded.username
+                RETURNING id
+                """,
+                (
+                    source_row["source_type"],
+                    source_row["source_chat_id"],
+                    source_row.get("title"),
+                    source_row.get("username"),
+                ),
+            )
+            source_id = (await cursor.fetchone())[0]
+
         cursor = await db.execute(
             """
-            INSERT INTO messages 
+            INSERT INTO messages
             (tg_chat_id, tg_message_id, original_message_id, from_user_id, received_at, forwarded_at, source_id, text, raw_json)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
-                tg_chat_id,
-                tg_message_id,
-                original_message_id,
-                from_user_id,
-                received_at,
-                forwarded_at,
+                message_row["tg_chat_id"],
+                message_row["tg_message_id"],
+                message_row.get("original_message_id"),
+                message_row.get("from_user_id"),
+                message_row["received_at"],
+                message_row.get("forwarded_at"),
                 source_id,
-                text,
-                raw_json,
+                message_row.get("text"),
+                message_row["raw_json"],
             ),
         )
-        await db.commit()
-        return cursor.lastrowid
+        message_id = cursor.lastrowid
 
+        results = []
+        for row in file_rows:
+            cursor = await db.execute(
+                """
+                INSERT INTO files (file_unique_id, last_seen_file_id, file_size, mime_type, original_name)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(file_unique_id)
+                DO UPDATE SET
+                    last_seen_file_id=excluded.last_seen_file_id,
+                    updated_at=?
+                RETURNING id, status, local_path
+                """,
+                (
+                    row["file_unique_id"],
+                    row["file_id"],
+                    row.get("file_size"),
+                    row.get("mime_type"),
+                    row.get("original_name"),
+                    now,
+                ),
+            )
+            file_id, status, local_path = await cursor.fetchone()
+            results.append(
+                {
+                    "file_id": file_id,
+                    "status": status,
+                    "local_path": local_path,
+                    "job_id": None,
+                }
+            )
 
-async def insert_message_file(
-    message_id: int,
-    file_id: int,
-    tg_file_id: str,
-    tg_file_unique_id: str,
-    kind: str,
-    caption: Optional[str] = None,
-):
-    """Link a message to a file. Ignores if already exists."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
+        await db.executemany(
             """
             INSERT OR IGNORE INTO message_files (message_id, file_id, tg_file_id, tg_file_unique_id, kind, caption)
             VALUES (?, ?, ?, ?, ?, ?)
             """,
-            (message_id, file_id, tg_file_id, tg_file_unique_id, kind, caption),
-        )
-        await db.commit()
-
-
-async def upsert_file(
-    file_unique_id: str,
-    last_seen_file_id: str,
-    file_size: Optional[int] = None,
-    mime_type: Optional[str] = None,
-    original_name: Optional[str] = None,
-) -> int:
-    """Insert or update a file, return file_id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        cursor = await db.execute(
-            """
-            INSERT INTO files (file_unique_id, last_seen_file_id, file_size, mime_type, original_name)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(file_unique_id) 
-            DO UPDATE SET 
-                last_seen_file_id=excluded.last_seen_file_id,
-                updated_at=datetime('now')
-            RETURNING id
-            """,
-            (file_unique_id, last_seen_file_id, file_size, mime_type, original_name),
+            [
+                (
+                    message_id,
+                    result["file_id"],
+                    row["file_id"],
+                    row["file_unique_id"],
+                    row["kind"],
+                    row.get("caption"),
+                )
+                for row, result in zip(file_rows, results)
+            ],
         )
-        row = await cursor.fetchone()
-        await db.commit()
-        return row[0]
-
-
-async def update_file_downloaded(
-    file_id: int, local_path: str, local_size: int, sha256: Optional[str] = None
-):
-    """Mark a file as downloaded."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
-            """
-            UPDATE files 
-            SET local_path=?, local_size=?, sha256=?, status='DOWNLOADED', updated_at=datetime('now')
-            WHERE id=?
-            """,
-            (local_path, local_size, sha256, file_id),
-        )
-        await db.commit()
 
+        for result in results:
+            if result["status"] == "DOWNLOADED" and result["local_path"]:
+                # Caller verifies the file on disk and re-queues if missing
+                continue
+            cursor = await db.execute(
+                """
+                INSERT INTO jobs (file_id, message_id, status)
+                VALUES (?, ?, 'QUEUED')
+                ON CONFLICT DO NOTHING
+                RETURNING id
+                """,
+                (result["file_id"], message_id),
+            )
+            job_row = await cursor.fetchone()
+            result["job_id"] = job_row[0] if job_row else None
 
-async def update_file_failed(file_id: int):
-    """Mark a file as failed."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
-            """
-            UPDATE files 
-            SET status='FAILED', updated_at=datetime('now')
-            WHERE id=?
-            """,
-            (file_id,),
-        )
         await db.commit()
 
-
-async def get_file_by_id(file_id: int) -> Optional[Dict[str, Any]]:
-    """Get file by id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM files WHERE id=?", (file_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    # Only after the commit: until then readers still see the old row
+    if source_id is not None:
+        _invalidate_source(source_id)
+    return message_id, source_id, results
 
 
-async def get_file_by_unique_id(file_unique_id: str) -> Optional[Dict[str, Any]]:
-    """Get file by unique_id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM files WHERE file_unique_id=?", (file_unique_id,)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+PENDING_JOBS_BATCH_SIZE = 100
 
 
-async def insert_job(file_id: int, message_id: int) -> Optional[int]:
+async def iter_pending_jobs(
+    batch_size: int = PENDING_JOBS_BATCH_SIZE,
+) -> AsyncIterator[Dict[str, Any]]:
     """
-    Insert a job for a file. Returns job_id if inserted, None if already exists.
+    Yield QUEUED jobs in creation (id) order.
+
+    Rows are fetched in keyset-paginated batches over idx_jobs_pending, so a
+    large backlog is never materialized at once and no reader connection is
+    held between batches.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        try:
+    last_id = 0
+    while True:
+        async with _read() as db:
             cursor = await db.execute(
                 """
-                INSERT INTO jobs (file_id, message_id, status)
-                VALUES (?, ?, 'QUEUED')
+                SELECT id, file_id, message_id
+                FROM jobs
+                WHERE status = 'QUEUED' AND id > ?
+                ORDER BY id
+                LIMIT ?
                 """,
-                (file_id, message_id),
+                (last_id, batch_size),
             )
-            job_id = cursor.lastrowid
-            await db.commit()
-            return job_id
-        except aiosqlite.IntegrityError:
-            return None
-
-
-async def get_pending_jobs() -> List[Dict[str, Any]]:
-    """Get all QUEUED jobs."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """
-            SELECT id, file_id, message_id
-            FROM jobs
-            WHERE status = 'QUEUED'
-            ORDER BY created_at
-            """
-        )
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
-
+            rows = await cursor.fetchall()
 
-async def update_job_running(job_id: int):
-    """Mark job as running."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
-            """
-            UPDATE jobs
-            SET status='RUNNING'
-            WHERE id=?
-            """,
-            (job_id,),
-        )
-        await db.commit()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]["id"]
 
 
-async def update_job_done(job_id: int):
-    """Mark job as done."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
-            """
-            UPDATE jobs
-            SET status='DONE', completed_at=datetime('now')
-            WHERE id=?
-            """,
-            (job_id,),
-        )
-        await db.commit()
+_JOB_FAILED_SQL = """
+    UPDATE jobs
+    SET status='FAILED', error=?, completed_at=?
+    WHERE id=?
+"""
 
 
 async def update_job_failed(job_id: int, error: str):
     """Mark job as failed."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
-            """
-            UPDATE jobs
-            SET status='FAILED', error=?, completed_at=datetime('now')
-            WHERE id=?
-            """,
-            (error, job_id),
-        )
-        await db.commit()
+    await _submit((_JOB_FAILED_SQL, (error, _now(), job_id)))
 
 
-async def insert_download_failure(
+async def fail_download(
+    job_id: int,
     file_id: int,
     file_unique_id: str,
     source_type: Optional[str],
@@ -367,12 +777,15 @@ async def insert_download_failure(
     bot_api_error: Optional[str],
     tdl_error: Optional[str],
 ):
-    """Record a download failure for statistics."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA foreign_keys=ON")
-        await db.execute(
+    """
+    Record a failed download atomically: the download_failures row (for
+    statistics), the file marked FAILED and the job marked FAILED.
+    """
+    now = _now()
+    await _submit(
+        (
             """
-            INSERT INTO download_failures 
+            INSERT INTO download_failures
             (file_id, file_unique_id, source_type, source_chat_id, original_name, error_type, bot_api_error, tdl_error)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
@@ -386,8 +799,33 @@ async def insert_download_failure(
                 bot_api_error,
                 tdl_error,
             ),
-        )
-        await db.commit()
+        ),
+        (
+            """
+            UPDATE files
+            SET status='FAILED', updated_at=?
+            WHERE id=?
+            """,
+            (now, file_id),
+        ),
+        (
+            _JOB_FAILED_SQL,
+            (f"Bot API: {bot_api_error}; tdl: {tdl_error}", now, job_id),
+        ),
+    )
+
+
+_MONTH_RE = re.compile(r"[0-9]{4}-[0-9]{2}")
+
+
+def _month_bounds(month: str) -> Tuple[str, str]:
+    """Half-open created_at range covering a 'YYYY-MM' month."""
+    year, mon = int(month[:4]), int(month[5:7])
+    if mon == 12:
+        year, mon = year + 1, 1
+    else:
+        mon += 1
+    return f"{month}-01", f"{year:04d}-{mon:02d}-01"
 
 
 async def get_failure_stats(month: Optional[str] = None) -> Dict[str, int]:
@@ -400,16 +838,22 @@ async def get_failure_stats(month: Optional[str] = None) -> Dict[str, int]:
     Returns:
         Dict with error_type counts
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    if month and not _MONTH_RE.fullmatch(month):
+        # Matches nothing, as the old strftime('%Y-%m') filter did
+        return {}
+
+    async with _read() as db:
         if month:
+            # Range on the raw column (not strftime(created_at)) so the
+            # covering idx_failures_created_type index can be used
             cursor = await db.execute(
                 """
                 SELECT error_type, COUNT(*) as count
                 FROM download_failures
-                WHERE strftime('%Y-%m', created_at) = ?
+                WHERE created_at >= ? AND created_at < ?
                 GROUP BY error_type
                 """,
-                (month,),
+                _month_bounds(month),
             )
         else:
             cursor = await db.execute(
@@ -420,22 +864,38 @@ async def get_failure_stats(month: Optional[str] = None) -> Dict[str, int]:
                 """
             )
         rows = await cursor.fetchall()
-        return {row[0]: row[1] for row in rows}
+        return {row["error_type"]: row["count"] for row in rows}
 
 
 async def get_message_by_id(message_id: int) -> Optional[Dict[str, Any]]:
-    """Get message by id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    """Get message by id.
+
+    raw_json is returned as stored (possibly compressed); callers that need
+    the JSON pass it through decode_raw_json, the download path does not.
+    """
+    async with _read() as db:
         cursor = await db.execute("SELECT * FROM messages WHERE id=?", (message_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        return await cursor.fetchone()
 
 
 async def get_source_by_id(source_id: int) -> Optional[Dict[str, Any]]:
-    """Get source by id."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    """Get source by id. Served from an in-memory LRU when possible."""
+    cached = _source_cache.get(source_id)
+    if cached is not None:
+        _source_cache.move_to_end(source_id)
+        return dict(cached)
+
+    epoch = _source_cache_epoch
+    async with _read() as db:
         cursor = await db.execute("SELECT * FROM sources WHERE id=?", (source_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        source = await cursor.fetchone()
+        if not source:
+            return None
+
+    if epoch != _source_cache_epoch:
+        # A source upsert committed meanwhile; this row may predate it
+        return dict(source)
+    _source_cache[source_id] = source
+    if len(_source_cache) > SOURCE_CACHE_SIZE:
+        _source_cache.popitem(last=False)
+    return dict(source)
@@ -1,12 +1,18 @@
 """File management utilities."""
 
 import asyncio
+import functools
+import os
 import re
 import hashlib
+import shutil
+import sys
+import uuid
 import aiofiles
 import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import AsyncIterator, Optional, Set, Tuple, Union
 import logging
 
 from app.config import (
@@ -17,11 +23,26 @@ from app.config import (
     WEBDAV_ENABLED,
     SAVE_TO_LOCAL,
     SAVE_TO_WEBDAV,
+    TDL_CPUSET,
 )
 
 logger = logging.getLogger(__name__)
 
+# Chunk size for streamed downloads (1 MiB amortizes per-write overhead)
+STREAM_CHUNK_SIZE = 1 << 20
 
+
+# Characters dropped from file and directory names. Keeps:
+# - Chinese characters (Unicode range \u4e00-\u9fff)
+# - Latin letters (A-Za-z)
+# - Numbers (0-9)
+# - Common safe symbols (._-)
+_DISALLOWED_CHARS = re.compile(r"[^\u4e00-\u9fffA-Za-z0-9._\-]")
+_MULTI_UNDERSCORE = re.compile(r"_+")
+
+
+# Pure function; chat titles in particular repeat for every archived file
+@functools.lru_cache(maxsize=4096)
 def sanitize_filename(name: str, max_length: int = 64) -> str:
     """
     Sanitize filename to keep original name as much as possible.
@@ -35,16 +56,10 @@ def sanitize_filename(name: str, max_length: int = 64) -> str:
     name = name.replace(" ", "_")
 
     # Remove emoji and other special Unicode characters while preserving Chinese, letters, numbers, and safe symbols
-    # This regex keeps:
-    # - Chinese characters (Unicode range \u4e00-\u9fff)
-    # - Latin letters (A-Za-z)
-    # - Numbers (0-9)
-    # - Common safe symbols (._-)
-    # - Other common punctuation that might be in filenames
-    name = re.sub(r"[^\u4e00-\u9fffA-Za-z0-9._\-]", "", name)
+    name = _DISALLOWED_CHARS.sub("", name)
 
     # Clean up multiple underscores
-    name = re.sub(r"_+", "_", name)
+    name = _MULTI_UNDERSCORE.sub("_", name)
     name = name.strip("_.")
 
     if len(name) > max_length:
@@ -92,44 +107,80 @@ def get_archive_path(
     return archive_dir, full_path
 
 
+# Hashing gets its own threads so a few multi-GB files can't tie up the
+# default executor that to_thread file ops and DNS lookups share
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="sha256")
+
+
+def _sha256_file(file_path: Path) -> str:
+    # Unbuffered: file_digest reads straight into its own buffer via readinto
+    with open(file_path, "rb", buffering=0) as f:
+        # Whole-file read: let the kernel read ahead aggressively
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
 async def calculate_sha256(file_path: Path) -> str:
-    """Calculate SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
+    """Calculate SHA256 hash of a file.
+
+    hashlib.file_digest reads and hashes in C with the GIL released, so it
+    runs in a worker thread instead of an aiofiles read loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_pool, _sha256_file, file_path)
 
-    async with aiofiles.open(file_path, "rb") as f:
-        while True:
-            chunk = await f.read(8192)
-            if not chunk:
-                break
-            sha256_hash.update(chunk)
 
-    return sha256_hash.hexdigest()
+def shutdown_hash_pool():
+    """Stop the hashing threads (call on shutdown)."""
+    _hash_pool.shutdown(wait=False, cancel_futures=True)
 
 
-async def verify_file(file_path: Path, expected_size: Optional[int] = None) -> bool:
+def verify_file(
+    file_path: Union[str, Path], expected_size: Optional[int] = None
+) -> bool:
     """
     Verify file exists and optionally check size.
+
+    Uses a single stat call; accepts plain strings so callers holding a DB
+    path do not need to build a Path first.
     """
-    if not file_path.exists():
+    try:
+        st = os.stat(file_path)
+    except OSError:
         return False
 
-    if expected_size is not None:
-        actual_size = file_path.stat().st_size
-        if actual_size != expected_size:
-            logger.warning(
-                f"Size mismatch: expected {expected_size}, got {actual_size}"
-            )
-            return False
+    if expected_size is not None and st.st_size != expected_size:
+        logger.warning(f"Size mismatch: expected {expected_size}, got {st.st_size}")
+        return False
 
     return True
 
 
+# Local directories already created by this process; archive dirs are
+# reused by every file from the same source, so the mkdir is skipped after
+# the first. An entry is dropped when a write into it finds it gone.
+_known_dirs: Set[Path] = set()
+
+
+def _ensure_dir(path: Path):
+    """Create path (with parents) unless this process already did."""
+    if path not in _known_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _known_dirs.add(path)
+
+
 async def atomic_write(temp_path: Path, final_path: Path):
     """
     Atomically move temp file to final location.
     """
-    final_path.parent.mkdir(parents=True, exist_ok=True)
-    temp_path.rename(final_path)
+    _ensure_dir(final_path.parent)
+    try:
+        os.replace(temp_path, final_path)
+    except FileNotFoundError:
+        _known_dirs.discard(final_path.parent)
+        raise
     logger.debug(f"Moved {temp_path} -> {final_path}")
 
 
@@ -138,6 +189,38 @@ def get_temp_path(final_path: Path) -> Path:
     return final_path.with_suffix(final_path.suffix + ".part")
 
 
+async def write_stream(
+    chunks: AsyncIterator[bytes], target_path: Path
+) -> Tuple[str, int]:
+    """
+    Write a byte stream to target_path via a temp file, hashing on the fly.
+
+    The SHA256 is computed while the bytes are written, so the file never
+    has to be read back from disk.
+
+    Returns:
+        (sha256_hexdigest, size)
+    """
+    sha256_hash = hashlib.sha256()
+    size = 0
+
+    temp_path = get_temp_path(target_path)
+    _ensure_dir(temp_path.parent)
+
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            async for chunk in chunks:
+                sha256_hash.update(chunk)
+                await f.write(chunk)
+                size += len(chunk)
+    except FileNotFoundError:
+        _known_dirs.discard(temp_path.parent)
+        raise
+
+    await atomic_write(temp_path, target_path)
+    return sha256_hash.hexdigest(), size
+
+
 # ============ tdl Download ============
 
 
@@ -159,18 +242,39 @@ def build_message_url(
         return f"https://t.me/{source_username}/{original_message_id}"
 
     if source_chat_id:
-        chat_id_str = str(source_chat_id)
-        if chat_id_str.startswith("-100"):
-            clean_id = chat_id_str[4:]
-        elif chat_id_str.startswith("-"):
-            clean_id = chat_id_str[1:]
-        else:
-            clean_id = chat_id_str
-        return f"https://t.me/c/{clean_id}/{original_message_id}"
+        return f"https://t.me/c/{_clean_chat_id(source_chat_id)}/{original_message_id}"
 
     return None
 
 
+@functools.lru_cache(maxsize=4096)
+def _clean_chat_id(source_chat_id: int) -> str:
+    """Strip the -100 / - prefix from a chat id for t.me/c/ links."""
+    chat_id_str = str(source_chat_id)
+    if chat_id_str.startswith("-100"):
+        return chat_id_str[4:]
+    if chat_id_str.startswith("-"):
+        return chat_id_str[1:]
+    return chat_id_str
+
+
+# Only the last TDL_OUTPUT_TAIL bytes of each tdl stream are kept (enough for
+# the error message); long runs don't accumulate their whole output.
+TDL_OUTPUT_TAIL = 16 * 1024
+
+
+async def _read_tail(stream: Optional[asyncio.StreamReader]) -> bytes:
+    """Drain a subprocess stream, keeping only its last TDL_OUTPUT_TAIL bytes."""
+    if stream is None:
+        return b""
+    tail = bytearray()
+    while chunk := await stream.read(STREAM_CHUNK_SIZE):
+        tail += chunk
+        if len(tail) > TDL_OUTPUT_TAIL:
+            del tail[:-TDL_OUTPUT_TAIL]
+    return bytes(tail)
+
+
 async def download_with_tdl(
     message_url: str,
     target_path: Path,
@@ -185,9 +289,16 @@ async def download_with_tdl(
     Returns:
         (success, error_message)
     """
+    # Unique per call so concurrent tdl runs never see each other's files
+    temp_dir = target_path.parent / f".tmp-{uuid.uuid4().hex}"
     try:
-        temp_dir = target_path.parent / ".tmp"
-        temp_dir.mkdir(parents=True, exist_ok=True)
+        _ensure_dir(target_path.parent)
+        try:
+            temp_dir.mkdir()
+        except FileNotFoundError:
+            # Archive dir removed since we created it
+            _known_dirs.discard(target_path.parent)
+            raise
 
         cmd = [
             "tdl",
@@ -199,39 +310,49 @@ async def download_with_tdl(
             "--continue",
             "--skip-same",
         ]
+        if TDL_CPUSET and sys.platform.startswith("linux"):
+            # Go sizes GOMAXPROCS from the affinity mask, so this also caps
+            # tdl's scheduler threads
+            cmd = ["taskset", "-c", TDL_CPUSET, *cmd]
 
         logger.info(f"Running tdl: {' '.join(cmd)}")
 
+        # tdl renders a progress bar on stdout; discard it rather than buffer
+        # it in memory unless we're debugging, only stderr is needed for
+        # error reporting.
+        debug = logger.isEnabledFor(logging.DEBUG)
         process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            *cmd,
+            stdout=asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
         )
 
-        stdout, stderr = await process.communicate()
+        stdout, stderr, _ = await asyncio.gather(
+            _read_tail(process.stdout),
+            _read_tail(process.stderr),
+            process.wait(),
+        )
+        if stdout:
+            logger.debug(f"tdl output: {stdout.decode('utf-8', errors='ignore')}")
 
         if process.returncode != 0:
-            stderr_msg = stderr.decode("utf-8", errors="ignore")
-            stdout_msg = stdout.decode("utf-8", errors="ignore")
-            error = stderr_msg or stdout_msg or "Unknown error"
+            error = stderr.decode("utf-8", errors="ignore") or "Unknown error"
             logger.error(f"tdl failed: {error}")
             return False, f"tdl exit {process.returncode}: {error.strip()}"
 
         # Find downloaded file
-        downloaded_files = [f for f in temp_dir.glob("*") if f.is_file()]
-        if not downloaded_files:
+        with os.scandir(temp_dir) as it:
+            entries = [e for e in it if e.is_file(follow_symlinks=False)]
+        if not entries:
             return False, "No file found in tdl output"
 
-        if len(downloaded_files) > 1:
-            logger.warning(f"Multiple files found, using first: {downloaded_files}")
+        if len(entries) > 1:
+            logger.warning(
+                f"Multiple files found, using first: {[e.name for e in entries]}"
+            )
 
         # Move to target
-        target_path.parent.mkdir(parents=True, exist_ok=True)
-        downloaded_files[0].rename(target_path)
-
-        # Cleanup temp dir
-        try:
-            temp_dir.rmdir()
-        except:
-            pass
+        os.replace(entries[0].path, target_path)
 
         logger.info(f"tdl download successful: {target_path}")
         return True, None
@@ -240,6 +361,10 @@ async def download_with_tdl(
         logger.error(f"tdl exception: {e}")
         return False, str(e)
 
+    finally:
+        # Cleanup temp dir (and any partial download left by a failed run)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
 
 # ============ WebDAV Upload ============
 
@@ -255,6 +380,53 @@ def get_webdav_path(local_path: Path) -> str:
         return "/" + local_path.name
 
 
+# Shared WebDAV session: keeps connections (and TLS sessions) alive across
+# uploads and MKCOLs. Created lazily on the running loop.
+WEBDAV_CONNECTION_LIMIT = 16
+WEBDAV_KEEPALIVE_TIMEOUT = 300
+WEBDAV_DNS_CACHE_TTL = 300
+# aiohttp's default 64 KiB response buffer is what trips "Chunk too big" on
+# large streamed bodies; a bigger one also drains the socket in fewer reads
+WEBDAV_READ_BUFSIZE = 10 * 1024 * 1024
+_webdav_session: Optional[aiohttp.ClientSession] = None
+
+# Constant for the process lifetime; computed once instead of per upload
+_WEBDAV_AUTH: Optional[aiohttp.BasicAuth] = (
+    aiohttp.BasicAuth(WEBDAV_USERNAME, WEBDAV_PASSWORD) if WEBDAV_ENABLED else None
+)
+_WEBDAV_BASE: str = WEBDAV_URL.rstrip("/") if WEBDAV_URL else ""
+
+
+def _get_webdav_session() -> aiohttp.ClientSession:
+    global _webdav_session
+    if _webdav_session is None or _webdav_session.closed:
+        _webdav_session = aiohttp.ClientSession(
+            auth=_WEBDAV_AUTH,
+            read_bufsize=WEBDAV_READ_BUFSIZE,
+            connector=aiohttp.TCPConnector(
+                limit=WEBDAV_CONNECTION_LIMIT,
+                keepalive_timeout=WEBDAV_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=WEBDAV_DNS_CACHE_TTL,
+            ),
+        )
+    return _webdav_session
+
+
+async def close_webdav_session():
+    """Close the shared WebDAV session (call on shutdown)."""
+    global _webdav_session
+    if _webdav_session is not None:
+        await _webdav_session.close()
+        _webdav_session = None
+
+
+async def _read_chunks(path: Path) -> AsyncIterator[bytes]:
+    """Yield a file's contents in STREAM_CHUNK_SIZE pieces."""
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
 async def upload_to_webdav(local_path: Path) -> Tuple[bool, Optional[str]]:
     """
     Upload file to WebDAV server.
@@ -263,31 +435,33 @@ async def upload_to_webdav(local_path: Path) -> Tuple[bool, Optional[str]]:
         return True, None
 
     remote_path = get_webdav_path(local_path)
-    url = WEBDAV_URL.rstrip("/") + remote_path
+    url = _WEBDAV_BASE + remote_path
 
     logger.info(f"Uploading to WebDAV: {local_path} -> {url}")
 
     try:
-        auth = aiohttp.BasicAuth(WEBDAV_USERNAME, WEBDAV_PASSWORD)
-
-        async with aiohttp.ClientSession(auth=auth) as session:
-            # Create parent directories
-            parent_path = "/".join(remote_path.split("/")[:-1])
-            if parent_path:
-                await _ensure_webdav_dirs(session, parent_path)
-
-            # Upload file
-            async with aiofiles.open(local_path, "rb") as f:
-                content = await f.read()
-
-            async with session.put(url, data=content) as resp:
-                if resp.status in (200, 201, 204):
-                    logger.info(f"WebDAV upload successful: {remote_path}")
-                    return True, None
-                else:
-                    error = f"WebDAV upload failed: HTTP {resp.status}"
-                    logger.error(error)
-                    return False, error
+        session = _get_webdav_session()
+
+        # Create parent directories
+        parent_path = "/".join(remote_path.split("/")[:-1])
+        if parent_path:
+            await _ensure_webdav_dirs(session, parent_path)
+
+        # Upload file, streamed from disk; a sized PUT instead of
+        # chunked transfer encoding
+        size = await asyncio.to_thread(os.path.getsize, local_path)
+        async with session.put(
+            url,
+            data=_read_chunks(local_path),
+            headers={"Content-Length": str(size)},
+        ) as resp:
+            if resp.status in (200, 201, 204):
+                logger.info(f"WebDAV upload successful: {remote_path}")
+                return True, None
+            else:
+                error = f"WebDAV upload failed: HTTP {resp.status}"
+                logger.error(error)
+                return False, error
 
     except Exception as e:
         error = f"WebDAV upload error: {e}"
@@ -295,10 +469,18 @@ async def upload_to_webdav(local_path: Path) -> Tuple[bool, Optional[str]]:
         return False, error
 
 
+# Remote directories known to exist (MKCOL answered 201 or 405); uploads into
+# them skip the MKCOL round trips
+_known_webdav_dirs: Set[str] = set()
+
+
 async def _ensure_webdav_dirs(session: aiohttp.ClientSession, path: str):
     """
     Ensure WebDAV directories exist (recursive MKCOL).
     """
+    if path in _known_webdav_dirs:
+        return
+
     parts = path.strip("/").split("/")
     current = ""
 
@@ -306,11 +488,16 @@ async def _ensure_webdav_dirs(session: aiohttp.ClientSession, path: str):
         if not part:
             continue
         current += "/" + part
-        url = WEBDAV_URL.rstrip("/") + current
+        if current in _known_webdav_dirs:
+            continue
+        url = _WEBDAV_BASE + current
 
         try:
             async with session.request("MKCOL", url) as resp:
-                if resp.status not in (201, 405, 409):
+                if resp.status in (201, 405):
+                    # Created, or already there
+                    _known_webdav_dirs.add(current)
+                elif resp.status != 409:
                     logger.warning(f"MKCOL {current} returned {resp.status}")
         except Exception as e:
             logger.warning(f"MKCOL {current} failed: {e}")
@@ -1,15 +1,102 @@
 """Markdown logging utilities."""
 
-import aiofiles
+import asyncio
+import os
 from pathlib import Path
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import logging
 
-from app.config import NOTES_PATH
+from app.config import NOTES_PATH, NOTES_BATCH_INTERVAL, NOTES_MAX_BUFFER
 
 logger = logging.getLogger(__name__)
 
+# Pending appends as (markdown_path, text); None asks the writer to stop.
+# Drained by a single background writer task, see start_writer().
+_md_queue: asyncio.Queue = asyncio.Queue()
+_writer_task: Optional[asyncio.Task] = None
+
+
+def _write_batch_sync(by_path: Dict[Path, List[str]]):
+    # Opened per batch rather than cached: a month file replaced or deleted
+    # behind our back (editor save, sync tool) is picked up again instead
+    # of writes going to the orphaned inode. Batching already amortizes
+    # the open.
+    for md_path, texts in by_path.items():
+        md_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(md_path, "a", encoding="utf-8") as f:
+            f.write("".join(texts))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.debug(f"Appended {len(texts)} entries to {md_path}")
+
+
+async def _write_batch(batch: List[Tuple[Path, str]]):
+    """Append a batch of entries with one write and fsync per file.
+
+    The whole batch is a single thread hop (stdlib file I/O) rather than
+    one aiofiles dispatch per open/write/flush.
+    """
+    by_path: Dict[Path, List[str]] = {}
+    for md_path, text in batch:
+        by_path.setdefault(md_path, []).append(text)
+
+    await asyncio.to_thread(_write_batch_sync, by_path)
+
+
+async def _writer_loop():
+    """Collect queued entries into batches and write them until stopped.
+
+    A batch is flushed once it holds NOTES_MAX_BUFFER bytes or
+    NOTES_BATCH_INTERVAL seconds after its first entry, whichever is first.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _md_queue.get()
+        deadline = loop.time() + NOTES_BATCH_INTERVAL
+        batch = []
+        buffered = 0
+        while item is not None:
+            batch.append(item)
+            buffered += len(item[1])
+            remaining = deadline - loop.time()
+            if buffered >= NOTES_MAX_BUFFER or remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_md_queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+
+        if batch:
+            try:
+                await _write_batch(batch)
+            except Exception as e:
+                logger.error(f"Failed to write markdown entries: {e}")
+
+        if item is None:
+            return
+
+
+def start_writer():
+    """Start the background markdown writer (call from the running loop)."""
+    global _writer_task
+    if _writer_task is None:
+        _writer_task = asyncio.create_task(_writer_loop())
+
+
+async def stop_writer():
+    """Flush pending entries and stop the background writer."""
+    global _writer_task
+    if _writer_task is not None:
+        _md_queue.put_nowait(None)
+        await _writer_task
+        _writer_task = None
+
+
+def _enqueue(md_path: Path, text: str):
+    """Queue a rendered entry for the background writer."""
+    _md_queue.put_nowait((md_path, text))
+
 
 def get_markdown_path(timestamp: str) -> Path:
     """
@@ -19,12 +106,18 @@ def get_markdown_path(timestamp: str) -> Path:
     Args:
         timestamp: ISO format timestamp string
     """
+    # ISO timestamps start with YYYY-MM; slicing gives the same month as a
+    # full parse (which does not convert time zones either)
+    month = timestamp[:7]
+    if len(month) == 7 and month[4] == "-" and month[:4].isdigit():
+        return NOTES_PATH / f"{month}.md"
+
     dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
     filename = dt.strftime("%Y-%m.md")
     return NOTES_PATH / filename
 
 
-async def append_message_entry(
+def append_message_entry(
     message_id: int,
     tg_chat_id: int,
     tg_message_id: int,
@@ -37,7 +130,7 @@ async def append_message_entry(
     attachments: List[Dict[str, Any]],
 ):
     """
-    Append a message entry to markdown log.
+    Queue a message entry for the markdown log.
 
     Args:
         message_id: Database message ID
@@ -60,60 +153,55 @@ async def append_message_entry(
     """
     md_path = get_markdown_path(received_at)
 
-    # Build entry
-    lines = []
-    lines.append(
-        f"\n## {received_at} msg:{message_id} tg:{tg_chat_id}/{tg_message_id}\n"
+    # Optional parts render as "" so the entry is built in one f-string
+    title_part = f' "{source_title}"' if source_title else ""
+    forwarded_part = f"forwarded_at: {forwarded_at}\n" if forwarded_at else ""
+    text_part = f"text: {text}\n" if text else ""
+    attachments_part = (
+        "\nattachments:\n" + "".join(_render_attachment(a) for a in attachments)
+        if attachments
+        else ""
     )
 
-    # Source info
-    source_info = f"source: {source_type} {source_chat_id}"
-    if source_title:
-        source_info += f' "{source_title}"'
-    lines.append(f"{source_info}\n")
-
-    # Forwarded time
-    if forwarded_at:
-        lines.append(f"forwarded_at: {forwarded_at}\n")
-
-    # Text
-    if text:
-        lines.append(f"text: {text}\n")
-
-    # Attachments
-    if attachments:
-        lines.append("\nattachments:\n")
-        for att in attachments:
-            kind = att.get("kind", "unknown")
-            name = att.get("original_name", "unnamed")
-            size = att.get("file_size", 0)
-            unique_id = att.get("file_unique_id", "")
-            status = att.get("status", "NEW")
-
-            att_line = f'- file: {kind} name="{name}" size={size} unique_id={unique_id}'
-
-            if status == "DOWNLOADED" and att.get("local_path"):
-                att_line += f" status=DOWNLOADED path={att['local_path']}"
-            elif status == "QUEUED" and att.get("job_id"):
-                att_line += f" status=QUEUED job:{att['job_id']}"
-            elif att.get("is_duplicate") and att.get("local_path"):
-                att_line += f" status=DUPLICATE path={att['local_path']}"
-            else:
-                att_line += f" status={status}"
-
-            lines.append(att_line + "\n")
-
-    lines.append("\n")
+    _enqueue(
+        md_path,
+        f"\n## {received_at} msg:{message_id} tg:{tg_chat_id}/{tg_message_id}\n"
+        f"source: {source_type} {source_chat_id}{title_part}\n"
+        f"{forwarded_part}{text_part}{attachments_part}\n",
+    )
 
-    # Append to file
-    md_path.parent.mkdir(parents=True, exist_ok=True)
-    async with aiofiles.open(md_path, "a", encoding="utf-8") as f:
-        await f.writelines(lines)
 
-    logger.info(f"Appended message entry to {md_path}")
+# Status -> renderer for the attachment status suffix; a renderer returns
+# None when the attachment lacks the field it shows, and the generic
+# rendering is used instead
+_STATUS_RENDERERS: Dict[str, Callable[[Dict[str, Any]], Optional[str]]] = {
+    "DOWNLOADED": lambda a: (
+        f"DOWNLOADED path={a['local_path']}" if a.get("local_path") else None
+    ),
+    "QUEUED": lambda a: f"QUEUED job:{a['job_id']}" if a.get("job_id") else None,
+}
+
+
+def _render_attachment(att: Dict[str, Any]) -> str:
+    """Render one attachment line of a message entry."""
+    status = att.get("status", "NEW")
+    render = _STATUS_RENDERERS.get(status)
+    status_part = render(att) if render else None
+    if status_part is None:
+        if att.get("is_duplicate") and att.get("local_path"):
+            status_part = f"DUPLICATE path={att['local_path']}"
+        else:
+            status_part = status
+
+    return (
+        f'- file: {att.get("kind", "unknown")} '
+        f'name="{att.get("original_name", "unnamed")}" '
+        f'size={att.get("file_size", 0)} '
+        f'unique_id={att.get("file_unique_id", "")} status={status_part}\n'
+    )
 
 
-async def append_job_complete(
+def append_job_complete(
     job_id: int,
     message_id: int,
     file_unique_id: str,
@@ -124,7 +212,7 @@ async def append_job_complete(
     received_at: str = None,
 ):
     """
-    Append a job completion entry to markdown log.
+    Queue a job completion entry for the markdown log.
 
     Args:
         job_id: Job ID
@@ -136,32 +224,21 @@ async def append_job_complete(
         sha256: SHA256 hash (optional)
         received_at: Original message timestamp (for determining which month file)
     """
-    md_path = get_markdown_path(
-        received_at if received_at else datetime.utcnow().isoformat() + "Z"
-    )
+    now_dt = datetime.now(timezone.utc)
+    md_path = get_markdown_path(received_at if received_at else now_dt.isoformat())
+
+    now = now_dt.strftime("%Y-%m-%d %H:%M:%SZ")
 
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ")
+    sha_part = f" sha256={sha256}" if sha256 else ""
 
-    lines = []
-    lines.append(
+    _enqueue(
+        md_path,
         f"\n### COMPLETE {now} job:{job_id} msg:{message_id} file:{file_unique_id}\n"
+        f"- method={method} path={local_path} size={local_size}{sha_part}\n\n",
     )
-    lines.append(f"- method={method} path={local_path} size={local_size}")
-
-    if sha256:
-        lines.append(f" sha256={sha256}")
-
-    lines.append("\n\n")
-
-    # Append to file
-    md_path.parent.mkdir(parents=True, exist_ok=True)
-    async with aiofiles.open(md_path, "a", encoding="utf-8") as f:
-        await f.writelines(lines)
 
-    logger.info(f"Appended job completion to {md_path}")
 
-
-async def append_job_failed(
+def append_job_failed(
     job_id: int,
     message_id: int,
     file_unique_id: str,
@@ -171,7 +248,7 @@ async def append_job_failed(
     received_at: str = None,
 ):
     """
-    Append a job failure entry to markdown log.
+    Queue a job failure entry for the markdown log.
 
     Args:
         job_id: Job ID
@@ -182,37 +259,25 @@ async def append_job_failed(
         tdl_error: tdl error message
         received_at: Original message timestamp
     """
-    md_path = get_markdown_path(
-        received_at if received_at else datetime.utcnow().isoformat() + "Z"
-    )
+    now_dt = datetime.now(timezone.utc)
+    md_path = get_markdown_path(received_at if received_at else now_dt.isoformat())
+
+    now = now_dt.strftime("%Y-%m-%d %H:%M:%SZ")
 
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%SZ")
+    error_type_part = f"- error_type={error_type}" if error_type else ""
+    bot_api_part = f"- bot_api_error: {bot_api_error}" if bot_api_error else ""
+    tdl_part = f"- tdl_error: {tdl_error}" if tdl_error else ""
 
-    lines = []
-    lines.append(
+    _enqueue(
+        md_path,
         f"\n### FAILED {now} job:{job_id} msg:{message_id} file:{file_unique_id}\n"
+        f"{error_type_part}{bot_api_part}{tdl_part}\n\n",
     )
 
-    if error_type:
-        lines.append(f"- error_type={error_type}")
-    if bot_api_error:
-        lines.append(f"- bot_api_error: {bot_api_error}")
-    if tdl_error:
-        lines.append(f"- tdl_error: {tdl_error}")
-
-    lines.append("\n\n")
-
-    # Append to file
-    md_path.parent.mkdir(parents=True, exist_ok=True)
-    async with aiofiles.open(md_path, "a", encoding="utf-8") as f:
-        await f.writelines(lines)
 
-    logger.info(f"Appended job failure to {md_path}")
-
-
-async def append_failure_stats(month: str, stats: Dict[str, int]):
+def append_failure_stats(month: str, stats: Dict[str, int]):
     """
-    Append monthly failure statistics summary.
+    Queue a monthly failure statistics summary for the markdown log.
 
     Args:
         month: Month in format "YYYY-MM"
@@ -220,18 +285,12 @@ async def append_failure_stats(month: str, stats: Dict[str, int]):
     """
     md_path = NOTES_PATH / f"{month}.md"
 
-    lines = [
-        f"\n## 下载失败统计 ({month})\n",
-        "| 错误类型 | 数量 |",
-        "|---------|------|",
-    ]
-    for error_type, count in stats.items():
-        lines.append(f"| {error_type} | {count} |")
-    lines.append("\n")
-
-    # Append to file
-    md_path.parent.mkdir(parents=True, exist_ok=True)
-    async with aiofiles.open(md_path, "a", encoding="utf-8") as f:
-        await f.writelines([l + "\n" for l in lines])
-
-    logger.info(f"Appended failure stats to {md_path}")
+    rows = "".join(f"| {error_type} | {count} |\n" for error_type, count in stats.items())
+
+    _enqueue(
+        md_path,
+        f"\n## 下载失败统计 ({month})\n\n"
+        "| 错误类型 | 数量 |\n"
+        "|---------|------|\n"
+        f"{rows}\n\n",
+    )